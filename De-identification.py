@@ -17,71 +17,6 @@ from decimal import *
 
 # Additional functions not included in the de_id_functions.py file.
 
-# <codecell>
-
-def utilValues(cursor, tableName, varName):
-    """
-    cursor: sqlite cursor object
-    tableName: string, name of sqlite table
-    varName: string, name of variable to analyze
-    takes values of an integer or float variable and returns the 
-    mean, standard deviation, and entropy
-    """
-    entQry = selUnique(cursor, tableName, varName)
-    entropy = shannonEntropy(entQry)
-    cursor.execute("SELECT "+varName+" FROM "+tableName)
-    qry = cursor.fetchall()
-    qry = colToList(qry)
-    qry2 = textToFloat(qry)
-    if len(qry2)==0:
-        print "No values could be converted to numbers"
-        return
-    qryArray = np.array(qry2)
-    mean = qryArray.mean()
-    sd = qryArray.std()
-    return entropy, mean, sd
-
-# <codecell>
-
-def binAvg(cursor, tableName, nomVarName, numVarName):
-    """
-    cursor: sqlite cursor object
-    tableName: string, name of sqlite table
-    nomVarName: string, name of variable with nominal categories
-    numVarName: string, name of corresponding variable with numeric values
-    For two columns, one a categorical string representation (generalization)
-    of the numeric values in another column (for example column A 
-    contains "10-15" and then column B contains the actual values 
-    that are in that bin), will give a bin-level average of the true values
-    in that bin. Designed as a tool to help improve the quality of a 
-    binned (aka 'generalized') dataset. 
-    """
-    newVarName = nomVarName+"_avg"
-    getcontext().prec = 2
-    bins = selUnique(cursor,tableName,nomVarName)
-    avgDic = {}
-    for cat in bins:
-        cursor.execute("SELECT "+numVarName+" FROM "+tableName+" WHERE "+nomVarName+" = '"+cat[0]+"'")
-        qry = cursor.fetchall()
-        qry = colToList(qry)
-        qry2 = textToFloat(qry)
-        if len(qry2)==0:
-            print "No values could be converted to numbers: "+str(cat[0])
-            continue
-        qryArray = np.array(qry2)
-        mean = qryArray.mean()
-        mean = Decimal(mean)
-        mean = round(mean,2)
-        avgDic[cat[0]] = str(mean)
-    try:
-        addColumn(cursor,tableName,newVarName)
-        varIndex(cursor,tableName,newVarName)
-    except:
-        print "column "+newVarName+" already exists, overwriting..."
-        cursor.execute("UPDATE "+tableName+" SET "+newVarName+" = 'null'")
-    dataUpdate(cursor,tableName,nomVarName,avgDic,True,newVarName)
-        
-
 # <codecell>
 
 def utilMatrix(cursor, tableName, varList):
@@ -93,144 +28,13 @@ def utilMatrix(cursor, tableName, varList):
     from the sqlite "Pragma table_info()" command.
     This function creates a Pandas dataframe/matrix of the entropy,
     mean, and standard deviation of the utility variables, 
-    index is the variable name, and columns are the statistics
+    index is the variable name, and columns are the statistics.
+    The statistics come from utilStats, one scan for all variables
     """
-    varNames = []
-    for var in varList:
-        varNames.append(var[1])
-    entropies = np.array([])
-    sds = np.array([])
-    means = np.array([])
-    uMatrix = pd.DataFrame(columns = ["Entropy","Mean","SD"], index = varNames)
-    for var in varNames:
-        ent, mean, sd = utilValues(cursor, tableName, var)
-        uMatrix.ix[var] = [ent, mean, sd]
+    varNames = [var[1] for var in varList]
+    utils = utilStats(cursor, tableName, varList)
+    uMatrix = pd.DataFrame([list(utils[var]) for var in varNames], columns = ["Entropy","Mean","SD"], index = varNames)
     return uMatrix
-    
-
-# <codecell>
-
-def textToFloat(txtList):
-    """
-    txtList: list of text values
-    returns a list of float values, 
-    skips values that cannot be converted
-    """
-    numList = []
-    for i in txtList:
-        try: numList.append(float(i))
-        except: pass
-    return numList
-
-# <codecell>
-
-def lDiversity(cursor, tableName, kkeyVar, senVar):
-    """
-    cursor: sqlite3 cursor object                                                                                                                                                                
-    tableName: string, name of main table
-    kkeyVar: string, name of variable that contains concatenation of all quasi-identifiers
-    senVar: string, name of variable whose value you do not want disclosed
-    Checks a dataset for "l-diversity", namely that in a k-anonymous block of records
-    if the sensitive value is homogeonous, then you have effectively disclosed the 
-    value of the sensitive record. Bluntly sets sensitive variable to blank if not l-diverse
-    """
-    qry = selUnique(cursor, tableName, kkeyVar)
-    for i in qry:
-        cursor.execute('SELECT '+senVar+' FROM '+tableName+' WHERE '+kkeyVar+' = "'+i[0]+'" GROUP BY '+senVar)
-        qry2 = cursor.fetchall()
-        if len(qry2) == 1:
-            cursor.execute('UPDATE '+tableName+' SET '+senVar+' = " " WHERE '+kkeyVar+' = "'+i[0]+'"')
-
-# <codecell>
-
-def optimumDrop2(cursor, tableName, userVar, k, nonUniqueList, nComb=1):
-    """                                                                                                                                                                                          
-    cursor: sqlite3 cursor object                                                                                                                                                                
-    tableName: string, name of main table                                                                                                                                                        
-    userVar: string, name of userid var                                                                                                                                                          
-    k: int, minimum cell size                                                                                                                                                                    
-    nonUniqueList: list of course_combo values already cleared for k-anonymity                                                                                                                   
-    nComb: int, number of courses to try to drop, default 1                                                                                                                                      
-    iteratively tries 'dropping' one course for all of the records                                                                                                                               
-    that are flagged as having a unique combo of courses                                                                                                                                         
-    then measures the entropy of the resulting group, and                                                                                                                                        
-    returns the position in courseList of the course to drop, along with the                                                                                                                     
-    course_combo values that will benefit from the drop                                                                                                                                          
-    """
-    qry = courseUserQry(cursor, tableName, userVar, 'True')
-    if len(qry)==0:
-        return qry
-    posLen = len(qry[0][0]) #assumes first variable in each tuple is the course combo, finds num of positions to change                                                                          
-    preList = qry[:]
-    preCombos = []
-    for i in preList:
-        preCombos.append(i[0])
-    preEntropy = shannonEntropy(preList)
-    postEntList = []
-    preCount = 0
-    for n in qry:
-        preCount += n[1]
-    print preCount
-    iterTemp = itertools.combinations(range(posLen),nComb)
-    dropCombos = []
-    while True:
-        try: dropCombos.append(iterTemp.next())
-        except: break
-    for i in dropCombos:
-        #print "dropCombo:"
-        #print i
-        postList = []
-        tmpList = qry[:]
-        for j in tmpList:
-            newString = ""
-            for l in range(posLen):
-                if l in i:
-                    newString+="0"
-                else:
-                    newString+=j[0][l]
-            postList.append((newString,j[1]))
-        try:
-            cursor.execute("DROP TABLE coursedrop")
-            cursor.execute("CREATE TABLE coursedrop (course_combo text, Count integer)")
-        except:
-            cursor.execute("CREATE TABLE coursedrop (course_combo text, Count integer)")
-        cursor.executemany("INSERT INTO coursedrop VALUES (?,?)",postList)
-        cursor.execute("SELECT course_combo, SUM(Count) FROM coursedrop GROUP BY course_combo")
-        postQry = cursor.fetchall()
-        postEntropy = shannonEntropy(postQry)
-        postCount = 0
-        for item in postQry:
-            postCount += item[1]
-        changeVals = []
-        for k in range(len(i)):
-            oldSpots = []
-            iterTemp = itertools.combinations(i,k+1)
-            while True:
-                try: oldSpots.append(iterTemp.next())
-                except: break
-            for l in oldSpots:
-                for m in postQry:
-                    mList = list(m[0])
-                    for n in l:
-                        mList[n] = '1'
-                    oldString = ''
-                    for p in mList:
-                        oldString+=p
-                    if m[1]>=k and oldString in preCombos:
-                        changeVals.append(oldString)
-                    elif (m[0] in nonUniqueList) and oldString in preCombos:
-                        changeVals.append(oldString)
-        #print "Length of ChangeVals: "+str(len(changeVals))
-        if len(changeVals)>0:
-            postEntList.append((i,preEntropy-postEntropy,changeVals))
-    if len(postEntList) == 0:
-        return []
-    first = True
-    low = (99,99,[])
-    for n in postEntList:
-        if n[1]<low[1] and n[1] > 0.0:
-            low = n
-    return low
 
 # <codecell>
 
@@ -255,7 +59,7 @@ def userKanon2(cursor, tableName, userVar, courseVar, k):
     while value != 0.0 and dropNum != 16:  
         print "DropNum: "+str(dropNum)
         print "non-anon value: "+str(value)
-        courseTup = optimumDrop2(cursor, tableName, userVar, k, nonUniqueList,dropNum)
+        courseTup = optimumMultiDrop(cursor, tableName, userVar, k, nonUniqueList, dropNum)
         #print "courseTup returned from OptimumDrop:"
         if len(courseTup) == 0 or len(courseTup[2])==0:
             dropNum +=1 
@@ -283,7 +87,7 @@ def userKanon2(cursor, tableName, userVar, courseVar, k):
 def courseDropper2(cursor, tableName, courseVar, courseName, changeVals, courseDict={}):
     """                                                                                                                                                                                          
     courseName: string, name of course to be dropped                                                                                                                                             
-    changeVals: list of strings, values of course_combo to drop                                                                                                                                  
+    changeVals: list, values of course_combo to drop
     courseDict: dictionary of courses and running tally of rows dropped                                                                                                                          
     drops course record where course equals courseName                                                                                                                                           
     AND uniqUserFlag = "True"                                                                                                                                                                    
@@ -291,7 +95,7 @@ def courseDropper2(cursor, tableName, courseVar, courseName, changeVals, courseD
     delCount = 0
     #print "len of changeVals: "+str(len(changeVals))
     for val in changeVals:
-        cursor.execute("SELECT SUM(Count) FROM "+tableName+" WHERE ("+courseVar+" = '"+courseName+"' AND uniqUserFlag = 'True' AND course_combo = '"+val+"')")
+        cursor.execute("SELECT SUM(Count) FROM "+tableName+" WHERE ("+courseVar+" = ? AND uniqUserFlag = 'True' AND course_combo = ?)", (courseName, val))
         qry = cursor.fetchall()
         #print "changeVal qry length:"+str(len(qry))
         if (qry[0][0]): delCount += qry[0][0]
@@ -306,8 +110,7 @@ def courseDropper2(cursor, tableName, courseVar, courseName, changeVals, courseD
     #if confirm == 'n':
     #    return
     #elif confirm == 'y':
-    for val in changeVals:
-        cursor.execute("DELETE FROM "+tableName+" WHERE ("+courseVar+" = '"+courseName+"' AND uniqUserFlag = 'True' AND course_combo = '"+val+"')")
+    cursor.executemany("DELETE FROM "+tableName+" WHERE ("+courseVar+" = ? AND uniqUserFlag = 'True' AND course_combo = ?)", [(courseName, val) for val in changeVals])
     #else:
     #    print "invalid choice, exiting function"
     return courseDict
@@ -383,7 +186,7 @@ sourceLoad(c,file,"original")
 
 # <headingcell level=4>
 
-# Drop the timestamp from the date fields.
+# Drop the timestamp from the date fields. If the dates are quasi-identifiers, pass a coarser level ("week", "month", "quarter" or "year"), or give dateLevels(c,table,"start_time_DI") to datafly as the hierarchy.
 
 # <codecell>
 
@@ -463,17 +266,7 @@ idGen(c,table,userVar,"MHxPC13")
 
 # <codecell>
 
-addColumn(c,table,'entropy')
-varIndex(c,table,'entropy')
-kkeyUpdate(c, table,varList,'entropy')
-
-# <codecell>
-
-qry = selUnique(c,table,'entropy')
-
-# <codecell>
-
-beginEntropy = shannonEntropy(qry)
+beginEntropy = jointEntropy(c, table, varList)
 beginEntropy
 
 # <headingcell level=4>
@@ -528,12 +321,7 @@ c.execute("DELETE FROM "+table+" WHERE uniqUserFlag = 'True'")
 
 # <codecell>
 
-kkeyUpdate(c, table,varList[:26],'entropy')
-
-# <codecell>
-
-qry = selUnique(c,table,'entropy')
-tmpEntropy = shannonEntropy(qry)
+tmpEntropy = jointEntropy(c, table, varList[:26])
 
 # <codecell>
 
@@ -554,8 +342,14 @@ entChg
 
 # <codecell>
 
+countries = contCounts(c,table,"final_cc_cname","continent")
+for th in [1000, 2500, 5000, 10000]:
+    print th, len(set(contSwapMap(countries, th).values()))
+
+# <codecell>
+
 initContVal = 5000
-contSwap(c,table,"final_cc_cname","continent",initContVal)
+contSwap(c,table,"final_cc_cname","continent",initContVal,countries)
 #outFile.write("Inserting continent names for countries with fewer than "+str(initContVal)+"\n")
 
 # <headingcell level=4>
@@ -747,7 +541,7 @@ qry2 = c.fetchall()
 c.execute("UPDATE "+table+" SET kCheckFlag = 'False'")
 for row in qry2:
     if row[0] >= 5:
-        c.execute('UPDATE '+table+' SET kCheckFlag = "True" WHERE kkey = "'+row[1]+'"')
+        c.execute('UPDATE '+table+' SET kCheckFlag = "True" WHERE kkey = ?', (row[1],))
 
 # <codecell>
 
@@ -20,23 +20,73 @@
 ##################################
 
 
-import sqlite3, csv, os, itertools, datetime, random, string, hashlib, pygeoip
-import pycountry, pp, cPickle, math, itertools
+import sqlite3, csv, os, itertools, datetime, random, string
+import math, itertools, collections, codecs
 from datetime import timedelta
 
+########################
+# Optional modules
+# pp, numpy, cPickle and hashlib are imported by the functions that use
+# them, so importing this module stays cheap and pp/numpy are optional
+#######################
+
+optionalModules = {}
+
+def optionalImport(name, required=None):
+    """
+    name: string, name of module
+    required: string, optional, what needs the module, e.g. "courseParallel"
+    imports the module the first time it is asked for and keeps it. Returns
+    None if it is not installed, or raises ImportError naming required
+    """
+    if name not in optionalModules:
+        try:
+            optionalModules[name] = __import__(name)
+        except ImportError:
+            optionalModules[name] = None
+    if optionalModules[name] is None and required is not None:
+        raise ImportError(required+" needs the "+name+" module, see the optional dependencies in README.md")
+    return optionalModules[name]
+
 ########################
 # Simple SQL commands as functions
 #######################
 
-def addColumn(cursor, tableName, varName):
-    cursor.execute("ALTER TABLE "+tableName+" ADD COLUMN "+varName+" text")
+def addColumn(cursor, tableName, varName, varType="text"):
+    cursor.execute("ALTER TABLE "+tableName+" ADD COLUMN "+varName+" "+varType)
 
 def selUnique(cursor, tableName, varName):
-    cursor.execute("SELECT "+varName+", SUM(Count) FROM "+tableName+" GROUP BY "+varName)
-    return cursor.fetchall()
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varName: string, name of variable
+    returns list of tuples (value, SUM(Count)), sorted by value. The result
+    is kept in the stats catalog and reused until the variable is written
+    """
+    catalog = statsCatalog(cursor)
+    key = (tableName.lower(), varName.lower())
+    if key not in catalog["hists"]:
+        if isDictEncoded(cursor, tableName, varName):
+            cursor.execute("SELECT d.value, SUM(t.Count) FROM "+tableName+" t LEFT JOIN "+dictTable(tableName, varName)+" d ON d.code = t."+varName+" GROUP BY t."+varName+" ORDER BY d.value")
+        else:
+            cursor.execute("SELECT "+varName+", SUM(Count) FROM "+tableName+" GROUP BY "+varName)
+        catalog["hists"][key] = cursor.fetchall()
+    return list(catalog["hists"][key])
 
 def simpleUpdate(cursor, tableName, varName, value):
+    since = statsStamp(cursor)
     cursor.execute("UPDATE "+tableName+" SET "+varName+" = '"+value+"'")
+    statsInvalidate(cursor, tableName, [varName], since)
+
+def colExists(cursor, tableName, varName):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varName: string, name of variable to look for
+    returns True if tableName has a column called varName
+    """
+    cursor.execute("Pragma table_info("+tableName+")")
+    return varName.lower() in [col[1].lower() for col in cursor.fetchall()]
 
 def varIndex(cursor,tableName, varName):
     """
@@ -55,58 +105,216 @@ def dbOpen(db):
     c = conn.cursor()
     return c
 
+def dbRollback(cursor):
+    """
+    cursor: sqlite3 cursor object
+    rolls back the open transaction and empties the stats catalog, which
+    could otherwise still describe the rows that were rolled back. Use it
+    in place of connection.rollback()
+    """
+    cursor.connection.rollback()
+    statsCatalogs.pop(cursor.connection, None)
+
 def dbClose(cursor, closeFlag=True):
     """
     cursor: sqlite cursor object
     run this before re-run, in order to cleanup database and close safely
     """
     cursor.execute("VACUUM")
+    statsCatalogs.pop(cursor.connection, None)
     if closeFlag:
         cursor.close()
 
+########################
+# Column statistics catalog
+# caches selUnique histograms and row counts per connection.
+# The catalog is only trusted while connection.total_changes
+# is what it was when the catalog was last brought up to date,
+# so any write that is not accounted for (raw SQL from the
+# notebook, say) empties it. Helpers that write take a
+# statsStamp first and call statsInvalidate with the
+# variables they wrote, which keeps the rest of the catalog.
+# Commits by other connections are caught by PRAGMA
+# data_version. A rollback does not move either counter, so
+# roll back with dbRollback, which empties the catalog
+#######################
+
+statsCatalogs = {}
+
+def statsCatalog(cursor):
+    """
+    cursor: sqlite3 cursor object
+    returns the stats catalog of the cursor's connection, a dict with
+    "hists" {(table, var): selUnique result} and "rows" {table: row count},
+    emptied first if rows were changed since it was last up to date, on
+    this connection or by a commit on another one
+    """
+    conn = cursor.connection
+    catalog = statsCatalogs.get(conn)
+    dataVersion = statsDataVersion(conn)
+    if catalog is None or catalog["changes"] != conn.total_changes or catalog["dataVersion"] != dataVersion:
+        catalog = {"changes": conn.total_changes, "dataVersion": dataVersion, "hists": {}, "rows": {}}
+        statsCatalogs[conn] = catalog
+    return catalog
+
+def statsDataVersion(conn):
+    """
+    conn: sqlite3 connection object
+    returns PRAGMA data_version, which changes when another connection
+    commits to the database. Read as a SELECT, since the sqlite3 module
+    commits the open transaction before a PRAGMA statement
+    """
+    return conn.execute("SELECT data_version FROM pragma_data_version").fetchall()[0][0]
+
+def statsStamp(cursor):
+    """
+    cursor: sqlite3 cursor object
+    returns the connection's change counter, take it before writing and pass
+    it to statsInvalidate afterwards
+    """
+    return cursor.connection.total_changes
+
+def statsInvalidate(cursor, tableName, varList=None, since=None):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table that was written
+    varList: list of strings, variables that were written, None for all of
+             them (rows added or deleted, or a table dropped)
+    since: int, statsStamp taken before the writes. None empties the whole
+           catalog, use that after raw SQL that changes a table's columns
+    drops the cached stats of the variables written. The rest of the catalog
+    is kept if it was up to date when the writes started, since the writes
+    since then are all accounted for, otherwise the whole catalog is dropped
+    """
+    conn = cursor.connection
+    catalog = statsCatalogs.get(conn)
+    if catalog is None:
+        return
+    if since is None or catalog["changes"] < since or catalog["dataVersion"] != statsDataVersion(conn):
+        del statsCatalogs[conn]
+        return
+    table = tableName.lower()
+    if varList is None:
+        for key in catalog["hists"].keys():
+            if key[0] == table:
+                del catalog["hists"][key]
+        catalog["rows"].pop(table, None)
+    else:
+        for var in varList:
+            catalog["hists"].pop((table, str(var).lower()), None)
+    catalog["changes"] = conn.total_changes
+
+def tableRows(cursor, tableName):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    returns the number of rows in tableName, kept in the stats catalog
+    """
+    catalog = statsCatalog(cursor)
+    table = tableName.lower()
+    if table not in catalog["rows"]:
+        cursor.execute("SELECT COUNT(*) FROM "+tableName)
+        catalog["rows"][table] = cursor.fetchall()[0][0]
+    return catalog["rows"][table]
+
+def distinctCount(cursor, tableName, varName):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varName: string, name of variable
+    returns the number of distinct values of varName, nulls counting as one,
+    from the stats catalog
+    """
+    return len(selUnique(cursor, tableName, varName))
+
 ##################
 # Functions that need to be done for a new dataset, but not thereafter
 #################
 
-def sourceLoad(cursor, fname, tableName):
+def sourceLoad(cursor, fname, tableName, batchSize=50000):
     """
     cursor: sqlite3 cursor object
     fname: string, file name/path for loading, .csv format
-    takes a .csv file and reads it into a sqlite database defined by the 
-    cursor object. 
+    batchSize: int, number of rows handed to each executemany call, default 50000
+    takes a .csv file and reads it into a sqlite database defined by the
+    cursor object. kkey and Count are created with the table, and all rows
+    are inserted in batches inside a single transaction
     CAUTION: will DELETE any existing table with same name
     """
+    since = statsStamp(cursor)
     try:
         cursor.execute("DROP TABLE "+tableName)
     except:
         pass
+    startTime = datetime.datetime.now()
+    rowCount = 0
     with open(fname, "r") as inFile:
         csvIn = csv.reader(inFile)
-        headerFlag = False
-        for row in csvIn:
-            if not(headerFlag):
-                headers = row
-                tableCreate = "CREATE TABLE "+tableName+" ("
-                tableInsert = "INSERT INTO "+tableName+" VALUES ("
-                for col in headers[:-1]:
-                    tableCreate += col+" text, "
-                    tableInsert += "?,"
-                tableCreate += headers[-1]+" text, kkey text)"
-                tableInsert += "?, ?)"
-                cursor.execute(tableCreate)
-                #varList = qiPicker(cursor, tableName)
-                headerFlag = True
-            else:
-                row = tuple(row)
-                lastVar = ""
-                #for i in varList:
-                #    lastVar += row[int(i[0])]
-                row += (lastVar,)
-                cursor.execute(tableInsert,tuple(row))
-    cursor.execute("ALTER TABLE "+tableName+" ADD COLUMN Count integer")
-    cursor.execute("UPDATE "+tableName+" SET Count =1")
-    #return varList
+        headers = csvIn.next()
+        tableCreate = "CREATE TABLE "+tableName+" ("
+        for col in headers:
+            tableCreate += col+" text, "
+        tableCreate += "kkey integer, Count integer)"
+        tableInsert = "INSERT INTO "+tableName+" VALUES ("+"?, "*len(headers)+"NULL, 1)"
+        cursor.execute(tableCreate)
+        cursor.connection.commit()
+        try:
+            while True:
+                batch = list(itertools.islice(csvIn, batchSize))
+                if not batch:
+                    break
+                cursor.executemany(tableInsert, batch)
+                rowCount += len(batch)
+        except:
+            dbRollback(cursor)
+            raise
+        cursor.connection.commit()
+    statsInvalidate(cursor, tableName, None, since)
+    timeReport("loaded "+str(rowCount)+" rows into "+tableName, rowCount, startTime)
+
+
+countryTable = {}
+contTables = {}
+# not ISO 3166 countries, but used as codes by the geoip lookup: anonymous proxy,
+# satellite provider, Asia/Pacific region and Europe. Their name is the code
+specialCodes = {'A1': 'Unknown/Other', 'A2': 'Unknown/Other', 'AP': 'Unknown/Other', 'EU': 'Other Europe'}
 
+def countryLookup():
+    """
+    returns dict of 2-char alpha country code to (country name, continent name),
+    read from the "country_codes" file next to this module the first time it is
+    needed and kept after that. The names are the ISO 3166 names that pycountry
+    gave and the continents are those of the "country_continent" file, except
+    for 21 codes that file has no name for, whose continents were assigned by
+    hand: AQ, BL, BV, CC, CW, CX, EH, FK, GS, HM, IO, MF, NF, NR, NU, PM, SJ,
+    ST, SX, TF and UM
+    """
+    if not countryTable:
+        fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), "country_codes")
+        with codecs.open(fname, "r", "utf-8") as inFile:
+            for line in inFile:
+                code, name, continent = line.rstrip("\n").split("\t")
+                countryTable[code] = (name, continent)
+    return countryTable
+
+def contLookup(inFileName=None):
+    """
+    inFileName: string, optional, name of a pickled dictionary of country name
+                to continent name, default the built-in table of countryLookup
+    returns dict of country name to continent name, including the special
+    codes and the empty string, loaded once per file and kept
+    """
+    if inFileName not in contTables:
+        if inFileName is None:
+            contDict = dict(countryLookup().itervalues())
+            contDict.update(specialCodes)
+            contDict[u''] = 'Unknown/Other'
+        else:
+            import cPickle
+            with open(inFileName,"r") as inFile:
+                contDict = cPickle.load(inFile)
+        contTables[inFileName] = contDict
+    return contTables[inFileName]
 
 def countryNamer(cursor, tableName, countryCode):
     """
@@ -114,18 +322,24 @@ def countryNamer(cursor, tableName, countryCode):
     tableName: string, name of table
     countryCode: string, name of variable containing 2-char alpha country codes
     takes a variable, finds the unique instances of country codes, generates map
-    to country names, then updates the country codes to country names where possible
+    to country names with countryLookup, then updates the country codes to
+    country names where possible. The special codes in specialCodes and codes
+    that are not found keep the code as the name
     """
     qry = selUnique(cursor,tableName,countryCode)
+    countries = countryLookup()
     cnameDict = {}
     for row in qry:
-        try:
-            cnameDict[row[0]]=pycountry.countries.get(alpha2=str(row[0])).name
-        except Exception as err:
-            print "Err %s on: cc=%s" % (err, row[0])
-            cnameDict[row[0]]=str(row[0])
+        if row[0] in countries:
+            cnameDict[row[0]] = countries[row[0]][0]
+        else:
+            if row[0] not in specialCodes:
+                print "no country for cc=%s" % (row[0],)
+            cnameDict[row[0]] = row[0]
+    since = statsStamp(cursor)
     try: addColumn(cursor,tableName,countryCode+"_cname")
     except: cursor.execute("UPDATE "+tableName+" SET "+countryCode+"_cname = 'NULL'")
+    statsInvalidate(cursor, tableName, [countryCode+"_cname"], since)
     dataUpdate(cursor,tableName,countryCode,cnameDict, True, countryCode+"_cname")
 
 
@@ -136,15 +350,16 @@ def contImport(cursor, tableName, inFileName, varName1, varName2='continent'):
     varName1: string, name of variable containing country names
     varName2: string, name of variable to write continent names to 
               default value is 'continent'
-    inFileName: string, name of file to read from
-    reads pickled dictionary from file, and then maps it to the specified
-    country variable, loading it into a variable called "continent", unless
-    otherwise specified
+    inFileName: string, name of file to read from, None for the built-in table
+    reads pickled dictionary from file (see contLookup), and then maps it to the
+    specified country variable, loading it into a variable called "continent",
+    unless otherwise specified
     """
-    with open(inFileName,"r") as inFile:
-        contDict = cPickle.load(inFile)
+    contDict = contLookup(inFileName)
+    since = statsStamp(cursor)
     try: addColumn(cursor,tableName,varName2)
     except: cursor.execute("UPDATE "+tableName+" SET "+varName2+" = 'NULL'")
+    statsInvalidate(cursor, tableName, [varName2], since)
     dataUpdate(cursor, tableName, varName1, contDict, True, varName2)
 
 def sortHash(inWord):
@@ -152,6 +367,7 @@ def sortHash(inWord):
     inWord: string to be hashed
     creates a salted hash of a string input, returns hash
     """
+    import hashlib
     chars = string.ascii_letters + string.digits + '!@#$%^&*()'
     random.seed = (os.urandom(1024))
     inWord.join(random.choice(chars) for i in range(6))
@@ -167,40 +383,35 @@ def idGen(cursor, tableName, varName, prefix):
     salted hash of the usernames (to prevent replicable sorting) and then creates
     sequential IDs for de-identification of the format course name + sequential number
     e.g. "MITx147300937" and adds these IDs to the table
+    the shuffled mapping is built inside sqlite in table "idhash", where the
+    sequence number is the rowid of the id after a random sort, and is then
+    written back with a single join-based UPDATE
     """
-    cursor.execute("SELECT DISTINCT "+varName+" FROM "+tableName)
-    length = len(cursor.fetchall())
-    count = len(str(length*10))
+    startTime = datetime.datetime.now()
+    since = statsStamp(cursor)
     try: varIndex(cursor, tableName, varName)
     except: pass
     try:
         cursor.execute("DROP TABLE idhash")
     except:
         pass
-    cursor.execute("CREATE TABLE idhash (id text, hash text, newid text)")
-    ids = selUnique(cursor,tableName,varName)
-    print "ids: "+str(len(ids))
-    counter = 1    
-    for row in ids:
-        #print counter
-        counter +=1
-        useridhash = random.random()
-        cursor.execute("INSERT INTO idhash VALUES (?, ?, ?)", (str(row[0]),str(useridhash),""))
-    cursor.execute("SELECT * FROM idhash ORDER BY hash")
-    hashTable = cursor.fetchall()
-    counter = 1
+    cursor.execute("CREATE TABLE idhash (seq integer PRIMARY KEY, id text, newid text)")
+    cursor.execute("INSERT INTO idhash (id) SELECT id FROM (SELECT DISTINCT "+varName+" AS id FROM "+tableName+") ORDER BY random()")
+    cursor.execute("SELECT COUNT(*) FROM idhash")
+    length = cursor.fetchall()[0][0]
+    print "ids: "+str(length)
+    count = len(str(length*10))
+    cursor.execute("UPDATE idhash SET newid = ? || substr(?||seq, ?)", (prefix, "0"*count, -count))
+    cursor.execute("CREATE INDEX idhash_idx ON idhash (id)")
     try:
         addColumn(cursor,tableName,"userid_DI")
         varIndex(cursor, tableName, "userid_DI")
-    except: 
+    except:
         print "userid_DI column already exists, overwriting"
-        cursor.execute("UPDATE "+tableName+" SET userid_DI = 'NULL'")
-    for row in hashTable:
-        input1 = str(row[0])
-        input2 = '{number:0{width}d}'.format(width=count, number = counter)
-        cursor.execute("UPDATE "+tableName+" SET userid_DI = '"+prefix+input2+"' WHERE "+varName+" = '"+input1+"'")
-        #print counter
-        counter +=1
+    cursor.execute("UPDATE "+tableName+" SET userid_DI = (SELECT newid FROM idhash WHERE id = "+tableName+"."+varName+")")
+    statsInvalidate(cursor, "idhash", None, since)
+    statsInvalidate(cursor, tableName, ["userid_DI"], since)
+    timeReport("ids assigned", length, startTime, "ids")
 
 
 #######################
@@ -216,10 +427,11 @@ def contExport(cursor, tableName, varName1, varName2, outFileName):
     outFileName: name of file to write to
     outputs the mapping of country to continent to a pickled file, for later import
     """
+    import cPickle
     headers = ["country", "continent"]
     selectItems = varName1+", "+varName2
     with open(outFileName,"w") as outFile:
-        cursor.execute("SELECT "+selectItems+" FROM "+tableName+" GROUP BY "+varName1)
+        cursor.execute("SELECT "+valueExpr(cursor, tableName, varName1)+", "+valueExpr(cursor, tableName, varName2)+" FROM "+tableName+" GROUP BY "+varName1)
         contDict = {}
         for row in cursor.fetchall():
             contDict[row[0]] = row[1]
@@ -229,37 +441,83 @@ def contExport(cursor, tableName, varName1, varName2, outFileName):
 # functions for generalizing
 ######################
 
-def contSwap(cursor, tableName, varName1, varName2, th):
+def contCounts(cursor, tableName, varName1, varName2):
     """
     cursor: sqlite cursor object
     tableName: string, name of table
     varName1: string, name of variable containing country names
     varName2: string, name of variable containing continent names
+    returns list of tuples (country, continent, SUM(Count)) from one grouped
+    query, pass it to contSwapMap or contSwap to try several thresholds
+    without counting again
+    """
+    cursor.execute("SELECT "+valueExpr(cursor, tableName, varName1)+", "+valueExpr(cursor, tableName, varName2)+", SUM(Count) FROM "+tableName+" GROUP BY "+varName1)
+    return cursor.fetchall()
+
+def contSwapMap(countries, th):
+    """
+    countries: list of tuples (country, continent, count), from contCounts
     th = int, k, minimum group size
-    creates new variable that combines the values from the 
-    continent column and the country column, inserting continents 
-    where the n in a country is lower than th
+    returns dict of country to the value it gets in the new variable, the
+    continent where the n in a country is lower than th
     """
-    try: 
-        addColumn(cursor,tableName,varName1+"_DI")
-        varIndex(c,tableName,varName1+"_DI")
-    except: cursor.execute("UPDATE "+tableName+" SET "+varName1+"_DI = 'NULL'")
-    cursor.execute("SELECT "+varName1+", "+varName2+", SUM(Count) FROM "+tableName+" GROUP BY "+varName1)
-    countries = cursor.fetchall()
-    print "countries: "+str(len(countries))
-    count = 1
+    swapMap = {}
     for country in countries:
-        #print count
-        count +=1
         cname = country[0]
         contname = country[1]
         num = country[2]
+        if cname is None:
+            continue
         if num <th or cname in ['A1','A2','AP','EU','']:
-            cursor.execute('UPDATE '+tableName+' SET '+varName1+'_DI = "'+contname+'" WHERE '+varName1+' = "'+cname+'"')
+            swapMap[cname] = contname
         else:
-            cursor.execute('UPDATE '+tableName+' SET '+varName1+'_DI = "'+cname+'" WHERE '+varName1+' = "'+cname+'"')
-    qry = selUnique(cursor, tableName, varName1+"_DI")
-    print "categories after swap: "+str(len(qry))
+            swapMap[cname] = cname
+    return swapMap
+
+def contSwap(cursor, tableName, varName1, varName2, th, countries=None):
+    """
+    cursor: sqlite cursor object
+    tableName: string, name of table
+    varName1: string, name of variable containing country names
+    varName2: string, name of variable containing continent names
+    th = int, k, minimum group size
+    countries: list, optional, result of contCounts, counted here if not given
+    creates new variable that combines the values from the 
+    continent column and the country column, inserting continents 
+    where the n in a country is lower than th
+    the swap is applied with dataUpdate, if varName1 is dictionary encoded
+    the new variable is encoded too and only its dictionary is rewritten.
+    returns the number of categories after the swap, counted on the new
+    variable as selUnique does, so rows without a country ('NULL') or
+    without a continent (NULL) are categories too
+    """
+    if countries is None:
+        countries = contCounts(cursor, tableName, varName1, varName2)
+    print "countries: "+str(len(countries))
+    swapMap = contSwapMap(countries, th)
+    if isDictEncoded(cursor, tableName, varName1):
+        colCopy(cursor, tableName, varName1, varName1+"_DI")
+        dataUpdate(cursor, tableName, varName1+"_DI", swapMap)
+        # rows without a country get 'NULL', as in the plain column below
+        since = statsStamp(cursor)
+        codes = dictCodes(cursor, tableName, varName1+"_DI", ['NULL'])
+        cursor.execute("UPDATE "+tableName+" SET "+varName1+"_DI = ? WHERE "+varName1+" IS NULL", (codes['NULL'],))
+        statsInvalidate(cursor, tableName, [varName1+"_DI"], since)
+    else:
+        since = statsStamp(cursor)
+        try: 
+            addColumn(cursor,tableName,varName1+"_DI")
+            varIndex(cursor,tableName,varName1+"_DI")
+        except: pass
+        # every country is in swapMap, only rows without one are set here
+        try: varIndex(cursor, tableName, varName1)
+        except: pass
+        cursor.execute("UPDATE "+tableName+" SET "+varName1+"_DI = 'NULL' WHERE "+varName1+" IS NULL")
+        statsInvalidate(cursor, tableName, [varName1+"_DI"], since)
+        dataUpdate(cursor, tableName, varName1, swapMap, True, varName1+"_DI")
+    catCount = distinctCount(cursor, tableName, varName1+"_DI")
+    print "categories after swap: "+str(catCount)
+    return catCount
 
 
 def tailFinder(cursor, tableName, varName, catSize):
@@ -323,12 +581,20 @@ def tailFinder(cursor, tableName, varName, catSize):
                     tailMap[str(j)]=">= "+str(hi)
                 elif not keyFlag:
                     tailMap[str(j)]=str(j)
+        if isDictEncoded(cursor, tableName, varName):
+            colCopy(cursor, tableName, varName, varName+"_DI")
+            # values tailMap does not cover, such as non int values, are
+            # left NULL as in the plain column
+            dataUpdate(cursor,tableName,varName+"_DI",dict((i[0], tailMap.get(i[0])) for i in qry))
+            return
+        since = statsStamp(cursor)
         try:
             addColumn(cursor,tableName,varName+"_DI")
             varIndex(cursor,tableName,varName+"_DI")
         except:
             print "column "+varName+"_DI"+" already exists, overwriting..."
             cursor.execute("UPDATE "+tableName+" SET "+varName+"_DI = "+varName)
+        statsInvalidate(cursor, tableName, [varName+"_DI"], since)
         dataUpdate(cursor,tableName,varName,tailMap,True,varName+"_DI")
 
 ###################
@@ -376,45 +642,170 @@ def numBinner(cursor, tableName, varName, bw=5):
     choice = raw_input("Copy into (n)ew variable or (o)verwrite?: ")
     while choice not in ['n','o']:
         choice = raw_input("Plz choose n or o: ")
-    if choice =='n':
+    if choice =='n' and isDictEncoded(cursor, tableName, varName):
+        colCopy(cursor, tableName, varName, varName+"_DI")
+        dataUpdate(cursor,tableName,varName+"_DI",newNumDict)
+    elif choice =='n':
+        since = statsStamp(cursor)
         try:
             addColumn(cursor, tableName, varName+"_DI")
-            varIndex(c,tableName,varName+"_DI")
+            varIndex(cursor,tableName,varName+"_DI")
         except:
             print "column "+varName+"_DI"+" already exists, overwriting..."
             cursor.execute("UPDATE "+tableName+" SET "+varName+"_DI = "+varName)
+        statsInvalidate(cursor, tableName, [varName+"_DI"], since)
         dataUpdate(cursor,tableName,varName,newNumDict,True,varName+"_DI")
     else:
         dataUpdate(cursor,tableName,varName,newNumDict)
 
-def dateSplit(cursor, tableName, varName):
+def binAvg(cursor, tableName, nomVarName, numVarName, stat="mean", newVarName=None):
     """
     cursor: sqlite cursor object
     tableName: string, name of table
-    varName: string, name of date variable stored as string
-    takes date/time stamps formatted "MM/DD/YYYYTxxxxxx" and strips out the date
-    requires the T to denote beginning of the time
-    """
-    try: varIndex(cursor, tableName, varName)
-    except: pass
+    nomVarName: string, name of variable with nominal categories
+    numVarName: string, name of corresponding variable with numeric values
+    stat: string, statistic written for each bin, "mean", "median", "sd",
+          "min" or "max", default "mean"
+    newVarName: string, optional, name of the new variable, default
+                nomVarName+"_avg" for the mean, nomVarName+"_"+stat otherwise
+    For two columns, one a categorical string representation (generalization)
+    of the numeric values in another column (for example column A
+    contains "10-15" and then column B contains the actual values
+    that are in that bin), will give a bin-level statistic of the true values
+    in that bin, rounded to 2 places. Designed as a tool to help improve the
+    quality of a binned (aka 'generalized') dataset.
+    The counts of every (bin, value) pair come from one GROUP BY, each distinct
+    value is converted to float once, values that do not convert are skipped,
+    and the new variable is written with one dataUpdate
+    returns dict of bin to dict of "n", "mean", "median", "sd", "min", "max"
+    """
+    if stat not in ["mean", "median", "sd", "min", "max"]:
+        raise ValueError("stat must be 'mean', 'median', 'sd', 'min' or 'max'")
+    if newVarName is None:
+        if stat == "mean":
+            newVarName = nomVarName+"_avg"
+        else:
+            newVarName = nomVarName+"_"+stat
+    startTime = datetime.datetime.now()
+    cursor.execute("SELECT "+valueExpr(cursor, tableName, nomVarName)+", "+valueExpr(cursor, tableName, numVarName)+", SUM(Count) FROM "+tableName+" GROUP BY "+nomVarName+", "+numVarName+" ORDER BY "+nomVarName)
+    binStats = {}
+    for cat, rows in itertools.groupby(cursor.fetchall(), lambda row: row[0]):
+        values = []
+        for row in rows:
+            try: num = float(row[1])
+            except: continue
+            if row[2]:
+                values.append((num, row[2]))
+        if cat is None or len(values) == 0:
+            print "No values could be converted to numbers: "+str(cat)
+            continue
+        values.sort()
+        n = sum(count for num, count in values)
+        mean = math.fsum(num*count for num, count in values)/n
+        sd = math.sqrt(math.fsum(count*(num-mean)**2 for num, count in values)/n)
+        middle = []
+        seen = 0
+        for num, count in values:
+            seen += count
+            while len(middle) < 2 and seen > [(n-1)/2, n/2][len(middle)]:
+                middle.append(num)
+        binStats[cat] = {"n": n, "mean": mean, "median": (middle[0]+middle[1])/2.0,
+                         "sd": sd, "min": values[0][0], "max": values[-1][0]}
+    avgDic = dict((cat, str(round(stats[stat], 2))) for cat, stats in binStats.iteritems())
+    since = statsStamp(cursor)
     try:
-        addColumn(cursor,tableName,varName+"_DI")
-        varIndex(c,tableName,varName+"_DI")
+        addColumn(cursor,tableName,newVarName)
+        varIndex(cursor,tableName,newVarName)
     except:
-        print "column "+varName+"_DI"+" already exists, overwriting..."
-        cursor.execute("UPDATE "+tableName+" SET "+varName+"_DI = 'NULL'")
-    qry = selUnique(cursor,tableName,varName)
-    for row in qry:
-        date = row[0]
-        if 'T' in date:
-            point = date.index('T')
-            dateNew = date[:point]
-        else:
-            dateNew = date
-        cursor.execute("UPDATE "+tableName+" SET "+varName+"_DI = '"+dateNew+"' WHERE "+varName+" = '"+date+"'")
- 
+        print "column "+newVarName+" already exists, overwriting..."
+        cursor.execute("UPDATE "+tableName+" SET "+newVarName+" = 'null'")
+    statsInvalidate(cursor, tableName, [newVarName], since)
+    dataUpdate(cursor,tableName,nomVarName,avgDic,True,newVarName)
+    timeReport(newVarName+" for "+str(len(binStats))+" bins", len(binStats), startTime, "bins")
+    return binStats
+
+dateLevelNames = ["day", "week", "month", "quarter", "year"]
 
+def dateExpr(varExpr, level="day"):
+    """
+    varExpr: string, sql expression of a date/time stamp, e.g. a variable name
+    level: string, "day", "week", "month", "quarter" or "year", default "day"
+    returns the sql expression that cuts the stamp down to level, labeled
+    "2013-08-23", "2013-W34" (ISO week, the year is that of the week's
+    Thursday), "2013-08", "2013-Q3" or "2013". The date is the part before
+    the T, coarser levels need it as YYYY-MM-DD and leave other values at
+    the date
+    """
+    if level not in dateLevelNames:
+        raise ValueError("level must be one of "+", ".join(dateLevelNames))
+    day = "(CASE WHEN instr("+varExpr+",'T') > 0 THEN substr("+varExpr+", 1, instr("+varExpr+",'T')-1) ELSE "+varExpr+" END)"
+    if level == "day":
+        return day
+    if level == "week":
+        thursday = "date("+day+", '-'||((strftime('%w',"+day+")+6)%7)||' days', '+3 days')"
+        label = "printf('%s-W%02d', strftime('%Y',"+thursday+"), (strftime('%j',"+thursday+")-1)/7+1)"
+    elif level == "month":
+        label = "substr("+day+", 1, 7)"
+    elif level == "quarter":
+        label = "substr("+day+", 1, 4)||'-Q'||((substr("+day+", 6, 2)+2)/3)"
+    else:
+        label = "substr("+day+", 1, 4)"
+    return "(CASE WHEN date("+day+") IS NULL THEN "+day+" ELSE "+label+" END)"
 
+def dateSplit(cursor, tableName, varName, level="day", newVarName=None):
+    """
+    cursor: sqlite cursor object
+    tableName: string, name of table
+    varName: string, name of date variable stored as string
+    level: string, "day", "week", "month", "quarter" or "year", default "day"
+    newVarName: string, optional, name of the new variable, default varName+"_DI"
+    takes date/time stamps formatted "YYYY-MM-DDTxxxxxx" and strips out the date,
+    or generalizes it to level (see dateExpr). requires the T to denote
+    beginning of the time. Every row is written by one UPDATE
+    """
+    if newVarName is None:
+        newVarName = varName+"_DI"
+    expr = dateExpr(valueExpr(cursor, tableName, varName), level)
+    since = statsStamp(cursor)
+    try:
+        addColumn(cursor,tableName,newVarName)
+        varIndex(cursor,tableName,newVarName)
+    except:
+        print "column "+newVarName+" already exists, overwriting..."
+        dictDecode(cursor, tableName, newVarName)
+    cursor.execute("UPDATE "+tableName+" SET "+newVarName+" = "+expr)
+    statsInvalidate(cursor, tableName, [newVarName], since)
+
+def dateLevels(cursor, tableName, varName, levels=["month", "quarter", "year"]):
+    """
+    cursor: sqlite cursor object
+    tableName: string, name of table
+    varName: string, name of date variable, e.g. made by dateSplit
+    levels: list of strings, coarser levels in order, from "week", "month",
+            "quarter" and "year", default month, quarter, year
+    returns generalization levels for datafly, level i maps the values of the
+    level before (the values of varName for the first) to level i, worked out
+    in sqlite by dateExpr from one query of the distinct values. Levels after
+    a week are taken from the week's Thursday, so each week goes to one month
+    """
+    for level in levels:
+        if level not in dateLevelNames[1:]:
+            raise ValueError("levels must be from "+", ".join(dateLevelNames[1:]))
+    base = "d"
+    labels = []
+    for level in levels:
+        labels.append(dateExpr(base, level))
+        if level == "week":
+            base = "(CASE WHEN date(d) IS NULL THEN d ELSE date(d, '-'||((strftime('%w',d)+6)%7)||' days', '+3 days') END)"
+    cursor.execute("SELECT v, "+", ".join(labels)+" FROM (SELECT v, "+dateExpr("v")+" AS d FROM (SELECT DISTINCT "+valueExpr(cursor, tableName, varName)+" AS v FROM "+tableName+"))")
+    rows = cursor.fetchall()
+    catMaps = [{} for level in levels]
+    for row in rows:
+        if row[0] is None:
+            continue
+        for i in range(len(levels)):
+            catMaps[i][row[i]] = row[i+1]
+    return catMaps
 
 #######################
 # Diagnostic functions
@@ -430,6 +821,7 @@ def nullMarker(cursor, tableName, varList):
     for the corresponding variable
     """
     for var in varList:
+        since = statsStamp(cursor)
         try: varIndex(cursor, tableName, var[1])
         except: pass
         try: 
@@ -438,7 +830,11 @@ def nullMarker(cursor, tableName, varList):
         except:
             simpleUpdate(cursor, tableName, var[1]+"_NF","NULL")
         simpleUpdate(cursor, tableName, var[1]+"_NF","1")
-        cursor.execute("UPDATE "+tableName+" SET "+var[1]+"_NF = '0' WHERE ("+var[1]+" = '' OR "+var[1]+" = 'NA' OR "+var[1]+" is NULL)")
+        if isDictEncoded(cursor, tableName, var[1]):
+            cursor.execute("UPDATE "+tableName+" SET "+var[1]+"_NF = '0' WHERE ("+var[1]+" IN (SELECT code FROM "+dictTable(tableName, var[1])+" WHERE value = '' OR value = 'NA' OR value IS NULL) OR "+var[1]+" is NULL)")
+        else:
+            cursor.execute("UPDATE "+tableName+" SET "+var[1]+"_NF = '0' WHERE ("+var[1]+" = '' OR "+var[1]+" = 'NA' OR "+var[1]+" is NULL)")
+        statsInvalidate(cursor, tableName, [var[1]+"_NF"], since)
 
 def nullWrap(cursor, tableName):
     """
@@ -461,6 +857,11 @@ def iterKcheck(cursor, tableName, k, nullFlag = True):
     iteratively checks for k-anonymity, first with one variable, then two
     etc. and then as variables are checked, records with null values for the other 
     variables are excluded from future checks
+    each null pattern is flagged with one UPDATE that joins against the
+    qualifying group keys, patterns are run in order since each one only
+    counts records not yet flagged by the earlier ones. The group key puts
+    a separator between the values, so dictionary codes such as 1,23 and
+    12,3 stay apart
     """
     # get list of QI variables
     varList = qiPicker(cursor, tableName)
@@ -474,11 +875,13 @@ def iterKcheck(cursor, tableName, k, nullFlag = True):
     for var in varList:
         nullVar = var[1]+"_NF"
         nullList.append((var[0],nullVar))
+    since = statsStamp(cursor)
     try:
         addColumn(cursor, tableName, "nullSum")
         varIndex(cursor, tableName, "nullSum")
     except: pass
-    kkeyUpdate(cursor, tableName, nullList, "nullSum")
+    cursor.execute("UPDATE "+tableName+" SET nullSum = "+kkeyFormula(nullList))
+    statsInvalidate(cursor, tableName, ["nullSum"], since)
     nullqry = selUnique(cursor, tableName, "nullSum")
     # create variable that says whether it's okay for future checks
     try: 
@@ -493,6 +896,8 @@ def iterKcheck(cursor, tableName, k, nullFlag = True):
         #simpleUpdate(cursor, tableName, "kCheckFlag","False")
         pass
     # run through each combo of null variables
+    totalStart = datetime.datetime.now()
+    since = statsStamp(cursor)
     for combo in nullqry:
         if '0' not in combo[0]: continue
         tmpVarList = []
@@ -501,46 +906,65 @@ def iterKcheck(cursor, tableName, k, nullFlag = True):
                 tmpVarList.append(varList[i])
         print "Checking "+combo[0]+"..."
         print tmpVarList
-        print datetime.datetime.now().time()
-        try: addColumn(cursor, tableName, "nullkkey")
-        except: pass
-        kkeyUpdate(cursor, tableName, tmpVarList, "nullkkey")
-        cursor.execute("SELECT nullkkey, SUM(Count) FROM "+tableName+" WHERE kCheckFlag = 'False' GROUP BY nullkkey")
-        qry = cursor.fetchall()
-        print "rows in qry: "+str(len(qry))+", time:"
-        print datetime.datetime.now().time()
-        if combo[0] == None:
-            print "error on "+str(combo)
-            return
-        for row in qry:
-            if row[0]== None:
-                print "error on "+str(row)
-                continue
-            if row[1]>=k:
-                cursor.execute('UPDATE '+tableName+' SET kCheckFlag = "True" WHERE (nullkkey = "'+row[0]+'" AND nullSum = "'+combo[0]+'")')
-            
-            
+        startTime = datetime.datetime.now()
+        if len(tmpVarList) == 0:
+            keyFormula = "'NULL'"
+        else:
+            keyFormula = kkeyFormula(tmpVarList, "char(31)", cursor, tableName)
+        cursor.execute("UPDATE "+tableName+" SET kCheckFlag = 'True' WHERE nullSum = ? AND "+keyFormula+" IN (SELECT "+keyFormula+" FROM "+tableName+" WHERE kCheckFlag = 'False' GROUP BY "+keyFormula+" HAVING SUM(Count) >= ?)", (combo[0], k))
+        timeReport("pattern "+combo[0]+", "+str(cursor.rowcount)+" rows flagged", combo[1], startTime)
+    statsInvalidate(cursor, tableName, ["kCheckFlag"], since)
+    timeReport("all null patterns", sum(combo[1] for combo in nullqry), totalStart)
+
+
 def kkeyUpdate(cursor, tableName, varList, var="kkey"):
     """
     cursor: sqlite cursor object
     tableName: string, name of table
     varList: list of tuples, form of (col number, var name), var name unicode
-    takes the QI variables identified by varList and concatenates into kkey
+    takes the QI variables identified by varList and gives every distinct
+    combination of their values a compact integer group id in kkey (a dense
+    rank, nulls count as 'NULL', see keyExpr). The distinct tuples are numbered in a
+    temporary table "kkeymap" and matched column by column, so two different
+    tuples never share an id
     """
+    since = statsStamp(cursor)
     try: varIndex(cursor, tableName, var)
     except: pass
-    kkey_formula = "IFNULL("
-    if len(varList) == 1:
-        kkey_formula = "IFNULL("+str(varList[0][1])+",'NULL')"
+    if len(varList) == 0:
+        cursor.execute("UPDATE "+tableName+" SET "+var+" = 1")
+        statsInvalidate(cursor, tableName, [var], since)
+        return
+    qiCols = [keyExpr(cursor, tableName, str(item[1])) for item in varList]
+    mapCols = ["v"+str(i) for i in range(len(varList))]
+    try:
+        cursor.execute("DROP TABLE temp.kkeymap")
+    except:
+        pass
+    cursor.execute("CREATE TEMP TABLE kkeymap (gid integer PRIMARY KEY, "+", ".join(mapCols)+")")
+    cursor.execute("INSERT INTO kkeymap ("+", ".join(mapCols)+") SELECT DISTINCT "+", ".join(qiCols)+" FROM "+tableName+" ORDER BY "+", ".join(qiCols))
+    cursor.execute("CREATE UNIQUE INDEX temp.kkeymap_idx ON kkeymap ("+", ".join(mapCols)+")")
+    matchList = [mapCols[i]+" = "+keyExpr(cursor, tableName, str(varList[i][1]), True) for i in range(len(varList))]
+    cursor.execute("UPDATE "+tableName+" SET "+var+" = (SELECT gid FROM kkeymap WHERE "+" AND ".join(matchList)+")")
+    cursor.execute("DROP TABLE temp.kkeymap")
+    statsInvalidate(cursor, tableName, [var], since)
+
+def kkeyFormula(varList, sep=None, cursor=None, tableName=None):
+    """
+    varList: list of tuples, form of (col number, var name), var name unicode
+    sep: string, optional, sql expression to put between the values, e.g. "char(31)"
+    cursor: sqlite cursor object, optional, with tableName for encoded variables
+    tableName: string, optional, name of table
+    returns the sql expression that concatenates the variables in varList,
+    with nulls written as 'NULL' (see keyExpr)
+    """
+    if cursor is None:
+        kkey_formula = ["IFNULL("+str(item[1])+",'NULL')" for item in varList]
     else:
-        for item in varList[:-1]:
-            kkey_formula += str(item[1])
-            kkey_formula += ",'NULL') || IFNULL("
-        kkey_formula += str(varList[-1][1])+",'NULL')"
-    #print kkey_formula
-    cursor.execute("UPDATE "+tableName+" SET "+var+" = "+kkey_formula)
-    #print "No column named kkey, could not update" #fix this later
- 
+        kkey_formula = [keyExpr(cursor, tableName, str(item[1])) for item in varList]
+    if sep is None:
+        return " || ".join(kkey_formula)
+    return (" || "+sep+" || ").join(kkey_formula)
 
 
 def qiPicker(cursor, tableName):
@@ -566,17 +990,12 @@ def grainSize(cursor, tableName, qiName):
     """
     cursor: sqlite3 cursor object
     qiName: string, name of variable to check for grain size
-    calls to table specified by cursor and tableName, then examines values,
-    returns a float, "grain size" as given by n of categories/n of items, smaller
-    value means less granular, bigger "grains"
-    """
-    cursor.execute("SELECT "+qiName+" FROM "+tableName)
-    valList = cursor.fetchall()
-    valList = colToList(valList)
-    groupList = valList[:]
-    groupList.sort()
-    groups = [(g[0], len(list(g[1]))) for g in itertools.groupby(groupList)]
-    return float(len(groups))/(len(groupList))
+    calls to table specified by cursor and tableName, counts the categories
+    in sqlite, returns a float, "grain size" as given by n of categories/n of
+    items, smaller value means less granular, bigger "grains"
+    both counts come from the stats catalog
+    """
+    return float(distinctCount(cursor, tableName, qiName))/tableRows(cursor, tableName)
 
 def genPicker(cursor, tableName, varList):
     """
@@ -599,26 +1018,42 @@ def isTableKanonymous(cursor, tableName, k):
     takes sqlite table that contains column called kkey which is concatenation of QI variables, checks for k-anonymity,
     returns bool and supression required for k-anonymity (float btw. 0,1)
     """
-    try:
-        cursor.execute("DROP TABLE kacheck")
-    except:
-        pass
-    cursor.execute("CREATE TABLE kacheck (kkey text, count integer)")
-    try:
-        cursor.execute("SELECT COUNT(*) FROM "+tableName+" WHERE kCheckFlag = 'False'")
-    except:
-        cursor.execute("SELECT COUNT(*) FROM "+tableName)
-    itemCount = cursor.fetchall()[0][0]
-    try:
-        cursor.execute("INSERT INTO kacheck SELECT kkey, SUM(Count) FROM "+tableName+" WHERE kCheckFlag = 'False' GROUP BY kkey")
-    except:
-        cursor.execute("INSERT INTO kacheck SELECT kkey, SUM(Count) FROM "+tableName+" GROUP BY kkey")
-    cursor.execute("SELECT SUM(Count) FROM kacheck WHERE count < "+str(k))
-    ltk = cursor.fetchall()[0][0]
-    if ltk != 0:
-        return False, float(ltk)/float(itemCount)
+    hist = classSizeHist(cursor, tableName)
+    supp = histSuppression(hist, k)
+    return supp == 0.0, supp
+
+def classSizeHist(cursor, tableName, var="kkey"):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table in db
+    var: string, name of the equivalence class variable, default "kkey"
+    returns dict of class size (sum of Count) to number of classes of that size,
+    computed in one aggregate query without writing a table. Only records with
+    kCheckFlag = 'False' are counted when that column exists
+    """
+    if colExists(cursor, tableName, "kCheckFlag"):
+        where = " WHERE kCheckFlag = 'False'"
     else:
-        return True, 0.0   
+        where = ""
+    cursor.execute("SELECT classSize, COUNT(*) FROM (SELECT SUM(Count) AS classSize FROM "+tableName+where+" GROUP BY "+var+") GROUP BY classSize")
+    return dict(cursor.fetchall())
+
+def histSuppression(hist, k):
+    """
+    hist: dict of class size to number of classes, from classSizeHist
+    k: int
+    returns share of records in classes smaller than k, i.e. the suppression
+    required for k-anonymity (float btw. 0,1)
+    """
+    total = 0
+    ltk = 0
+    for size, n in hist.iteritems():
+        total += size*n
+        if size < k:
+            ltk += size*n
+    if ltk == 0:
+        return 0.0
+    return float(ltk)/float(total)
 
 def kAnonWrap(cursor, tableName, k):
     """
@@ -633,6 +1068,200 @@ def kAnonWrap(cursor, tableName, k):
     a,b = isTableKanonymous(cursor, tableName,k)
     return a,b
 
+def datafly(cursor, tableName, varList, k, hierarchies, maxSupp=0.0):
+    """
+    cursor: sqlite cursor object
+    tableName: string, name of table
+    varList: list of tuples, form of (col number, var name), var name unicode,
+             the QI variables, generalized in place (use the _DI copies)
+    k: minimum group size
+    hierarchies: dict of var name to list of generalization levels, each level
+                 a dict mapping the values of the level before to coarser
+                 values, applied with dataUpdate (see numLevels)
+    maxSupp: float, suppression that is acceptable, default 0.0
+    runs Sweeney's datafly: while the suppression needed for k-anonymity is
+    above maxSupp, takes the QI variable with the most distinct values that
+    has a level left (as genPicker would) and generalizes it one level.
+    The distinct values of each variable are read once and then mapped along
+    with the levels, so picking the variable never rescans the table, and
+    the classes are counted by grouping on the variables directly. kkey is
+    updated at the end. Returns the suppression and a dict of var name to
+    the number of levels applied
+    """
+    distinct = dict((var[1], set(colToList(selUnique(cursor, tableName, var[1])))) for var in varList)
+    levels = dict((var[1], 0) for var in varList)
+    groupBy = ", ".join([str(var[1]) for var in varList])
+    while True:
+        supp = histSuppression(classSizeHist(cursor, tableName, groupBy), k)
+        print "suppression: "+str(supp)
+        if supp <= maxSupp:
+            break
+        candidates = [var[1] for var in varList if levels[var[1]] < len(hierarchies.get(var[1], []))]
+        if len(candidates) == 0:
+            print "no generalization levels left"
+            break
+        var = max(candidates, key=lambda v: len(distinct[v]))
+        catMap = hierarchies[var][levels[var]]
+        dataUpdate(cursor, tableName, var, catMap)
+        distinct[var] = set(catMap.get(value, value) for value in distinct[var])
+        levels[var] += 1
+        print "generalized "+var+" to level "+str(levels[var])+", "+str(len(distinct[var]))+" values"
+    kkeyUpdate(cursor, tableName, varList)
+    return supp, levels
+
+def numLevels(cursor, tableName, varName, widths):
+    """
+    cursor: sqlite cursor object
+    tableName: string, name of table
+    varName: string, name of variable containing integers
+    widths: list of ints, bin width of each level, each a multiple of the one before
+    returns generalization levels for datafly, level i puts the integer values
+    in bins of widths[i] starting at multiples of the width, labeled like
+    numBinner ("1980-1984"), values that are not integers are left as they are
+    """
+    values = colToList(selUnique(cursor, tableName, varName))
+    labels = {}
+    for value in values:
+        try: labels[value] = (int(value), value)
+        except: pass
+    levels = []
+    for bw in widths:
+        catMap = {}
+        for value, (num, label) in labels.items():
+            low = (num/bw)*bw
+            newLabel = str(low)+"-"+str(low+bw-1)
+            catMap[label] = newLabel
+            labels[value] = (num, newLabel)
+        levels.append(catMap)
+    return levels
+
+def lDiversity(cursor, tableName, kkeyVar, senVar, l=2, mode="distinct", c=3, blank=" ", update=True):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of main table
+    kkeyVar: string, name of equivalence class variable, e.g. kkey from kkeyUpdate
+    senVar: string, name of variable whose value you do not want disclosed
+    l: int, minimum diversity, default 2
+    mode: string, "distinct" (at least l distinct values), "entropy" (entropy
+          of the values, in bits, at least log2(l)) or "recursive" ((c,l),
+          the most frequent count is less than c times the sum of the counts
+          from the l-th most frequent on), default "distinct"
+    c: number, c of recursive (c,l)-diversity, default 3
+    blank: string, value written to senVar in classes that fail, default " "
+    update: bool, False only reports, default True
+    Checks a dataset for "l-diversity", namely that in a k-anonymous block of records
+    if the sensitive value is homogeonous, then you have effectively disclosed the
+    value of the sensitive record. The value counts (sum of Count) of every class
+    come from one grouped query, and senVar is set to blank in all the failing
+    classes with one UPDATE. The default reproduces the original check, blanking
+    classes with a single value
+    returns list of tuples (class, size, distinct values, entropy, passed)
+    """
+    if mode not in ["distinct", "entropy", "recursive"]:
+        raise ValueError("mode must be 'distinct', 'entropy' or 'recursive'")
+    startTime = datetime.datetime.now()
+    cursor.execute("SELECT "+kkeyVar+", "+senVar+", SUM(Count) FROM "+tableName+" GROUP BY "+kkeyVar+", "+senVar+" ORDER BY "+kkeyVar)
+    report = []
+    for kkey, rows in itertools.groupby(cursor.fetchall(), lambda row: row[0]):
+        counts = sorted([row[2] for row in rows], reverse=True)
+        entropy = shannonEntropy([(None, n) for n in counts if n > 0])
+        if mode == "distinct":
+            passed = len(counts) >= l
+        elif mode == "entropy":
+            # the entropy of l equal counts can come out a rounding error
+            # below log2(l)
+            passed = entropy >= math.log(l, 2)-1e-9
+        else:
+            passed = len(counts) >= l and counts[0] < c*sum(counts[l-1:])
+        report.append((kkey, sum(counts), len(counts), entropy, passed))
+    failed = [(row[0],) for row in report if not row[4]]
+    print str(len(failed))+" of "+str(len(report))+" classes not "+str(l)+"-diverse ("+mode+")"
+    if update and failed:
+        since = statsStamp(cursor)
+        if isDictEncoded(cursor, tableName, senVar):
+            value = dictCodes(cursor, tableName, senVar, [blank])[blank]
+        else:
+            value = blank
+        try:
+            cursor.execute("DROP TABLE temp.ldivfail")
+        except:
+            pass
+        cursor.execute("CREATE TEMP TABLE ldivfail (kkey PRIMARY KEY)")
+        cursor.executemany("INSERT INTO ldivfail VALUES (?)", failed)
+        cursor.execute("UPDATE "+tableName+" SET "+senVar+" = ? WHERE "+kkeyVar+" IN (SELECT kkey FROM ldivfail)", (value,))
+        cursor.execute("DROP TABLE temp.ldivfail")
+        statsInvalidate(cursor, tableName, [senVar], since)
+    timeReport("l-diversity of "+str(len(report))+" classes", len(report), startTime, "classes")
+    return report
+
+def tCloseness(cursor, tableName, kkeyVar, senVar, t=None, mode="ordered"):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of main table
+    kkeyVar: string, name of equivalence class variable, e.g. kkey from kkeyUpdate
+    senVar: string, name of sensitive variable
+    t: float, optional, largest distance allowed, classes further away are counted
+    mode: string, "ordered" (earth mover's distance over the values in numeric
+          order, for grades) or "equal" (every two values are distance 1 apart,
+          half the L1 distance, for categories), default "ordered"
+    measures how far the distribution of senVar (sum of Count) in each class is
+    from its distribution in the whole table. The global distribution comes from
+    selUnique, the classes are read in one pass over the table sorted by class.
+    In ordered mode only values that read as numbers are counted, classes without
+    any get distance None
+    returns list of tuples (class, size, distance, passed), passed is None without t
+    """
+    if mode not in ["ordered", "equal"]:
+        raise ValueError("mode must be 'ordered' or 'equal'")
+    startTime = datetime.datetime.now()
+    globalQry = selUnique(cursor, tableName, senVar)
+    if mode == "ordered":
+        numbers = {}
+        for row in globalQry:
+            try: numbers[row[0]] = float(row[0])
+            except: pass
+        globalQry = [row for row in globalQry if row[0] in numbers]
+        globalQry.sort(key=lambda row: numbers[row[0]])
+    if isDictEncoded(cursor, tableName, senVar):
+        codes = dictCodes(cursor, tableName, senVar, [])
+        globalQry = [(codes.get(row[0]), row[1]) for row in globalQry]
+    total = float(sum(row[1] for row in globalQry)) or 1.0
+    position = dict((row[0], i) for i, row in enumerate(globalQry))
+    q = [row[1]/total for row in globalQry]
+    scanCursor = cursor.connection.cursor()
+    scanCursor.execute("SELECT "+kkeyVar+", "+senVar+", SUM(Count) FROM "+tableName+" GROUP BY "+kkeyVar+", "+senVar+" ORDER BY "+kkeyVar)
+    report = []
+    for kkey, rows in itertools.groupby(scanCursor, lambda row: row[0]):
+        counts = {}
+        size = 0
+        for row in rows:
+            size += row[2]
+            if row[1] in position:
+                counts[position[row[1]]] = row[2]
+        n = float(sum(counts.values()))
+        if n == 0:
+            distance = None
+        elif mode == "equal":
+            present = sum(abs(counts[i]/n-q[i]) for i in counts)
+            distance = 0.5*(present+1.0-sum(q[i] for i in counts))
+        else:
+            cum = 0.0
+            steps = []
+            for i in range(len(q)-1):
+                cum += counts.get(i, 0)/n-q[i]
+                steps.append(abs(cum))
+            distance = math.fsum(steps)/max(len(q)-1, 1)
+        if t is None:
+            passed = None
+        else:
+            passed = distance is not None and distance <= t
+        report.append((kkey, size, distance, passed))
+    scanCursor.close()
+    if t is not None:
+        print str(sum(1 for row in report if not row[3]))+" of "+str(len(report))+" classes further than "+str(t)+" ("+mode+")"
+    timeReport("t-closeness of "+str(len(report))+" classes", len(report), startTime, "classes")
+    return report
+
 def userKanon(cursor, tableName, userVar, courseVar, k):
     """
     cursor: sqlite cursor object
@@ -645,15 +1274,20 @@ def userKanon(cursor, tableName, userVar, courseVar, k):
     that says which courses someone has taken
     then checks for unique count of courses taken
     and unique combinations of courses
+    course_combo, the combo frequencies and uniqUserFlag are computed once,
+    after each drop only the users whose rows were deleted are updated
     """
     courseList = courseComboUpdate(cursor,tableName,userVar,courseVar)
-    value, uniqueList, nonUniqueList = uniqUserCheck(cursor,tableName,userVar,k)
+    courseCount = len(courseList)
+    comboCounts = comboFreq(cursor, tableName, userVar)
+    value, uniqueList, nonUniqueList = uniqUserSplit(comboCounts, k, courseCount)
     uniqUserFlag(cursor, tableName, uniqueList)
     dropNum = 1
     courseDrops = {}
     while value != 0.0: #and dropNum != 17:
         print "non-anon value: "+str(value)
-        courseTup = optimumDrop(cursor, tableName, userVar, k, nonUniqueList)
+        preQry = [(comboEncode(combo, courseCount), n) for combo, n in comboCounts.iteritems() if n < k]
+        courseTup = optimumDrop(cursor, tableName, userVar, k, nonUniqueList, preQry=preQry)
         if len(courseTup) == 0 or len(courseTup[2])==0:
             #print "no more changes can be made"
             #dropNum +=1
@@ -662,46 +1296,63 @@ def userKanon(cursor, tableName, userVar, courseVar, k):
         courseNum = courseTup[0]
         changeVals = courseTup[2]
         courseName = courseList[courseNum]
+        prevDrops = courseDrops.get(courseName)
         courseDrops = courseDropper(cursor, tableName, courseVar, courseName, changeVals, courseDrops)
-        courseList = courseComboUpdate(cursor,tableName,userVar,courseVar)
-        value, uniqueList, nonUniqueList = uniqUserCheck(cursor,tableName,userVar,k)
-        uniqUserFlag(cursor, tableName, uniqueList)
+        if courseDrops.get(courseName) == prevDrops:
+            print "no rows deleted for "+courseName+", stopping"
+            return courseDrops
+        comboDropUpdate(cursor, tableName, courseNum, changeVals, comboCounts, k, courseCount)
+        value, uniqueList, nonUniqueList = uniqUserSplit(comboCounts, k, courseCount)
     return courseDrops
 
-def courseComboUpdate(cursor, tableName, userVar, courseVar):
+def courseComboUpdate(cursor, tableName, userVar, courseVar, batchSize=50000):
+    """
+    cursor: sqlite cursor object
+    tableName: string, name of table
+    userVar: string, name of userid variable
+    courseVar: string, name of course variable
+    batchSize: int, number of user combos written to the scratch table at a time
+    fills course_combo with a bitmask of the courses each user has taken, bit i
+    set meaning courseList[i] (see comboEncode). The combos are built from one
+    scan of the table sorted by user, staged in a temporary table "usercombo",
+    and written back with a single UPDATE. Returns courseList
+    """
     courseQry = selUnique(cursor, tableName, courseVar)
-    courseList = []
-    print "generating course list"
-    print datetime.datetime.now().time()
-    for row in courseQry:
-        courseList.append(row[0])
-    userQry = selUnique(cursor, tableName, userVar)
+    courseList = colToList(courseQry)
+    coursePos = dict((course, i) for i, course in enumerate(courseList))
+    startTime = datetime.datetime.now()
     print "creating/overwriting course_combo"
-    print datetime.datetime.now().time()
+    since = statsStamp(cursor)
     try:
-        addColumn(cursor,tableName,"course_combo")
+        addColumn(cursor,tableName,"course_combo","integer")
         varIndex(cursor,tableName,"course_combo")
     except:
-        simpleUpdate(cursor,tableName,"course_combo","NULL")
-    print "no. of unique users to update: "+str(len(userQry))
-    print datetime.datetime.now().time()
-    count = 1
-    for row in userQry:
-        cursor.execute("SELECT "+courseVar+" FROM "+tableName+" WHERE "+userVar+" = '"+row[0]+"'")
-        subQry = cursor.fetchall()
-        qryList = []
-        for subRow in subQry:
-            qryList.append(subRow[0])
-        courseCombo = ""
-        for course in courseList:
-            if course in qryList:
-                courseCombo += "1"
-            else:
-                courseCombo += "0"
-        #print "course_combo is: "+courseCombo
-        #print count
-        #count +=1
-        cursor.execute("UPDATE "+tableName+" SET course_combo = '"+courseCombo+"' WHERE "+userVar+" = '"+row[0]+"'")
+        pass
+    try:
+        cursor.execute("DROP TABLE temp.usercombo")
+    except:
+        pass
+    cursor.execute("CREATE TEMP TABLE usercombo (userid text PRIMARY KEY, combo integer)")
+    scanCursor = cursor.connection.cursor()
+    scanCursor.execute("SELECT "+userVar+", "+courseVar+" FROM "+tableName+" ORDER BY "+userVar)
+    batch = []
+    userCount = 0
+    for user, rows in itertools.groupby(scanCursor, lambda row: row[0]):
+        mask = 0
+        for row in rows:
+            mask |= 1 << coursePos[row[1]]
+        batch.append((user, comboEncode(mask, len(courseList))))
+        if len(batch) >= batchSize:
+            cursor.executemany("INSERT INTO usercombo VALUES (?, ?)", batch)
+            userCount += len(batch)
+            batch = []
+    cursor.executemany("INSERT INTO usercombo VALUES (?, ?)", batch)
+    userCount += len(batch)
+    scanCursor.close()
+    cursor.execute("UPDATE "+tableName+" SET course_combo = (SELECT combo FROM usercombo WHERE userid = "+tableName+"."+userVar+")")
+    cursor.execute("DROP TABLE temp.usercombo")
+    statsInvalidate(cursor, tableName, ["course_combo"], since)
+    timeReport("course_combo for "+str(userCount)+" users", userCount, startTime, "users")
     return courseList
 
 def userKCheckTable(cursor, tableName, userVar, records='all'):
@@ -710,11 +1361,12 @@ def userKCheckTable(cursor, tableName, userVar, records='all'):
     holds unique course_combo values by userid
     records option allows 'all', 'True', or 'False'
     """
+    since = statsStamp(cursor)
     try:
         cursor.execute("DROP TABLE userkcheck")
     except:
         pass
-    cursor.execute("CREATE TABLE userkcheck (useridUKC text, course_comboUKC text)")
+    cursor.execute("CREATE TABLE userkcheck (useridUKC text, course_comboUKC integer)")
     if records == 'all':
         cursor.execute("INSERT INTO userkcheck SELECT DISTINCT "+userVar+", course_combo FROM "+tableName)
     else:
@@ -723,6 +1375,7 @@ def userKCheckTable(cursor, tableName, userVar, records='all'):
     except:pass
     try:varIndex(cursor,"userkcheck","course_comboUKC")
     except:pass
+    statsInvalidate(cursor, "userkcheck", None, since)
 
 def courseUserQry(cursor, tableName, userVar, records='all'):
     """
@@ -763,37 +1416,237 @@ def uniqUserCheck(cursor,tableName,userVar,k):
             nonUniqueList.append(row[0])
     return float(count)/float(combos), uniqueList, nonUniqueList
 
+def comboFreq(cursor, tableName, userVar):
+    """
+    cursor: sqlite cursor object
+    tableName: string, name of table
+    userVar: string, name of userid variable
+    returns dict of course_combo bitset to number of users with that combo
+    """
+    qry = courseUserQry(cursor, tableName, userVar)
+    return dict((comboDecode(row[0]), row[1]) for row in qry)
+
+def uniqUserSplit(comboCounts, k, courseCount):
+    """
+    comboCounts: dict of course_combo bitset to number of users, see comboFreq
+    k: minimum group size
+    courseCount: int, number of courses in courseList
+    same result as uniqUserCheck, computed from comboCounts instead of the table
+    """
+    combos = 0
+    count = 0
+    uniqueList = []
+    nonUniqueList = []
+    for combo, n in comboCounts.iteritems():
+        combos += n
+        if n < k:
+            count += n
+            uniqueList.append(comboEncode(combo, courseCount))
+        else:
+            nonUniqueList.append(comboEncode(combo, courseCount))
+    if combos == 0:
+        return 0.0, uniqueList, nonUniqueList
+    return float(count)/float(combos), uniqueList, nonUniqueList
+
+def comboDropUpdate(cursor, tableName, courseNum, changeVals, comboCounts, k, courseCount):
+    """
+    cursor: sqlite cursor object
+    tableName: string, name of table
+    courseNum: int, position in courseList of the course that was dropped
+    changeVals: list, course_combo values passed to courseDropper
+    comboCounts: dict of course_combo bitset to number of users, updated in place
+    k: minimum group size
+    courseCount: int, number of courses in courseList
+    run after courseDropper. Moves the users with a combo in changeVals to
+    the combo without the dropped course, and fixes course_combo and
+    uniqUserFlag for those rows only, plus the rows of any combo that just
+    reached k
+    """
+    since = statsStamp(cursor)
+    bit = 1 << courseNum
+    moves = []
+    prevCounts = {}
+    for val in changeVals:
+        combo = comboDecode(val)
+        newCombo = combo & ~bit
+        users = comboCounts.pop(combo, 0)
+        if newCombo == 0: #the dropped course was the user's only course, no rows left
+            continue
+        if newCombo not in prevCounts:
+            prevCounts[newCombo] = comboCounts.get(newCombo, 0)
+        comboCounts[newCombo] = comboCounts.get(newCombo, 0)+users
+        moves.append((val, newCombo))
+    for newCombo, prev in prevCounts.iteritems():
+        if 0 < prev < k <= comboCounts[newCombo]:
+            cursor.execute("UPDATE "+tableName+" SET uniqUserFlag = 'False' WHERE course_combo = ?", (comboEncode(newCombo, courseCount),))
+    for val, newCombo in moves:
+        if comboCounts[newCombo] >= k:
+            flag = 'False'
+        else:
+            flag = 'True'
+        cursor.execute("UPDATE "+tableName+" SET course_combo = ?, uniqUserFlag = ? WHERE course_combo = ?", (comboEncode(newCombo, courseCount), flag, val))
+    statsInvalidate(cursor, tableName, ["course_combo", "uniqUserFlag"], since)
+
 def uniqUserFlag(cursor, tableName, uniqueList):
     """
     cursor: sqlite cursor object
     tableName: string, name of main table
     uniqueList: list, list of unique values of course_combo
     """
+    since = statsStamp(cursor)
     try: 
         addColumn(cursor, tableName, "uniqUserFlag")
         varIndex(cursor, tableName, "uniqUserFlag")
         simpleUpdate(cursor, tableName, "uniqUserFlag","False")
     except:
         simpleUpdate(cursor, tableName, "uniqUserFlag","False")
-    for item in uniqueList:
-        cursor.execute("UPDATE "+tableName+" SET uniqUserFlag = 'True' WHERE course_combo = '"+item+"'")
+    cursor.executemany("UPDATE "+tableName+" SET uniqUserFlag = 'True' WHERE course_combo = ?", [(item,) for item in uniqueList])
+    statsInvalidate(cursor, tableName, ["uniqUserFlag"], since)
 
 def shannonEntropy(itemList):
     """
     itemList: list of tuples (<<item>>, <<count>>) list of items to 
     determine entropy of
+    the logs are taken over one numpy array when numpy is installed,
+    items with a count of 0 are skipped
+    """
+    counts = [i[1] for i in itemList if i[1]]
+    total = float(sum(counts))
+    numpy = optionalImport("numpy")
+    if numpy is not None and counts:
+        p = numpy.array(counts, dtype=float)/total
+        return math.fsum(-p*numpy.log2(p))
+    terms = []
+    for count in counts:
+        p_i = count/total
+        terms.append(- p_i*math.log(p_i,2))
+    return math.fsum(terms)
+
+def countsEntropy(countBatches):
+    """
+    countBatches: iterable of lists of counts, e.g. fetchmany batches of a
+                  GROUP BY, need not fit in memory together
+    returns the entropy in bits of the distribution given by all the counts,
+    accumulated batch by batch as log2(N) - sum(c*log2(c))/N
     """
+    numpy = optionalImport("numpy")
     total = 0
-    entropy = 0
-    for i in itemList:
-        total += i[1]
-    for i in itemList:
-        p_i = float(i[1])/float(total)
-        entropy+= - p_i*math.log(p_i,2)
+    sums = []
+    for counts in countBatches:
+        counts = [count for count in counts if count]
+        if not counts:
+            continue
+        total += sum(counts)
+        if numpy is not None:
+            c_i = numpy.array(counts, dtype=float)
+            sums.append(math.fsum(c_i*numpy.log2(c_i)))
+        else:
+            sums.append(math.fsum(count*math.log(count,2) for count in counts))
+    if total == 0:
+        return 0.0
+    return max(math.log(total,2)-math.fsum(sums)/total, 0.0)
+
+def jointEntropy(cursor, tableName, varList, batchSize=50000):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varList: list of tuples, form of (col number, var name), var name unicode
+    batchSize: int, number of groups fetched at a time
+    returns the joint entropy in bits of the variables in varList (weighted by
+    Count, nulls as their own value), the same as running kkeyUpdate into an
+    "entropy" column and shannonEntropy on its selUnique, but from the counts
+    of a GROUP BY streamed in batches, without writing a column. A single
+    variable is taken from the stats catalog
+    """
+    startTime = datetime.datetime.now()
+    varNames = [str(var[1]) for var in varList]
+    if len(varNames) == 1:
+        entropy = shannonEntropy(selUnique(cursor, tableName, varNames[0]))
+    elif len(varNames) == 0:
+        entropy = 0.0
+    else:
+        scanCursor = cursor.connection.cursor()
+        scanCursor.execute("SELECT SUM(Count) FROM "+tableName+" GROUP BY "+", ".join(varNames))
+        def batches():
+            while True:
+                rows = scanCursor.fetchmany(batchSize)
+                if not rows:
+                    break
+                yield [row[0] for row in rows]
+        entropy = countsEntropy(batches())
+        scanCursor.close()
+    timeReport("joint entropy of "+str(len(varNames))+" variables", len(varNames), startTime, "variables")
     return entropy
 
+def utilStats(cursor, tableName, varList, batchSize=50000):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varList: list of tuples, form of (col number, var name), var name unicode
+    batchSize: int, number of rows fetched at a time
+    utility statistics for the utility matrix, returns dict of var name to
+    (entropy, mean, SD), mean and SD over the values that convert to float,
+    None if there are none. Values are weighted by Count. Variables whose
+    histogram is in the stats catalog are taken from there, the others are
+    counted together in one scan of the table, and each distinct value is
+    converted to float once
+    """
+    startTime = datetime.datetime.now()
+    catalog = statsCatalog(cursor)
+    hists = {}
+    scanVars = []
+    for var in varList:
+        key = (tableName.lower(), str(var[1]).lower())
+        if key in catalog["hists"]:
+            hists[var[1]] = dict(catalog["hists"][key])
+        elif var[1] not in scanVars:
+            scanVars.append(var[1])
+    rowCount = 0
+    if scanVars:
+        counts = [collections.defaultdict(int) for var in scanVars]
+        cols = range(len(scanVars))
+        scanCursor = cursor.connection.cursor()
+        scanCursor.execute("SELECT "+", ".join(scanVars)+", Count FROM "+tableName)
+        while True:
+            rows = scanCursor.fetchmany(batchSize)
+            if not rows:
+                break
+            rowCount += len(rows)
+            for row in rows:
+                n = row[-1]
+                for i in cols:
+                    counts[i][row[i]] += n
+        scanCursor.close()
+        for i, var in enumerate(scanVars):
+            if isDictEncoded(cursor, tableName, var):
+                values = dict((code, value) for value, code in dictCodes(cursor, tableName, var, []).iteritems())
+                hists[var] = dict((values.get(code), count) for code, count in counts[i].iteritems())
+            else:
+                hists[var] = dict(counts[i])
+    utils = {}
+    for var in varList:
+        n = 0
+        mean = 0.0
+        m2 = 0.0
+        for value, count in hists[var[1]].iteritems():
+            try: num = float(value)
+            except: continue
+            if math.isnan(num) or not count:
+                continue
+            n += count
+            delta = num-mean
+            mean += delta*count/n
+            m2 += delta*(num-mean)*count
+        entropy = shannonEntropy([item for item in hists[var[1]].items() if item[1]])
+        if n == 0:
+            utils[var[1]] = (entropy, None, None)
+        else:
+            utils[var[1]] = (entropy, mean, math.sqrt(m2/n))
+    timeReport("utility stats for "+str(len(varList))+" variables, "+str(len(scanVars))+" scanned", rowCount, startTime)
+    return utils
+
 
-def optimumDrop(cursor, tableName, userVar, k, nonUniqueList, nComb=1):
+def optimumDrop(cursor, tableName, userVar, k, nonUniqueList, nComb=1, preQry=None):
     """
     cursor: sqlite3 cursor object
     tableName: string, name of main table
@@ -801,62 +1654,37 @@ def optimumDrop(cursor, tableName, userVar, k, nonUniqueList, nComb=1):
     k: int, minimum cell size
     nonUniqueList: list of course_combo values already cleared for k-anonymity
     nComb: int, number of courses to try to drop, default 1
+    preQry: list of tuples (course_combo, number of users) for the flagged
+            combos, optional, read from the table with courseUserQry if not given
     iteratively tries 'dropping' one course for all of the records
     that are flagged as having a unique combo of courses
     then measures the entropy of the resulting group, and
     returns the position in courseList of the course to drop, along with the 
     course_combo values that will benefit from the drop
+    candidates are regrouped in memory, no scratch table is written
     """
-    qry = courseUserQry(cursor, tableName, userVar, 'True')
+    if preQry is None:
+        qry = courseUserQry(cursor, tableName, userVar, 'True')
+    else:
+        qry = preQry
     if len(qry)==0:
         return qry
-    posLen = len(qry[0][0]) #assumes first variable in each tuple is the course combo, finds num of positions to change
-    preList = qry[:]
+    width = comboWidth(qry[0][0])
+    preList = [(comboDecode(row[0]), row[1]) for row in qry]
+    nonUniqueSet = set(comboDecode(val) for val in nonUniqueList)
+    allBits = 0
+    for combo in [row[0] for row in preList]+list(nonUniqueSet):
+        allBits |= combo
+    posLen = allBits.bit_length() #every course is taken by someone, so this is the num of positions to change
     preEntropy = shannonEntropy(preList)
     postEntList = []
     preCount = 0
     for n in qry:
         preCount += n[1]
     print preCount
-    #iterTemp = itertools.combinations(range(posLen),nComb)
-    #dropCombos = list(iterTemp)
     for i in range(posLen):
-        postList = []
-        tmpList = qry[:]
-        for j in tmpList:
-            newString = ""
-            for l in range(posLen):
-                if l == i:
-                    newString+="0"
-                else:
-                    newString+=j[0][l]
-            postList.append((newString,j[1]))
-        try:
-            cursor.execute("DROP TABLE coursedrop")
-            cursor.execute("CREATE TABLE coursedrop (course_combo text, Count integer)")
-        except:
-            cursor.execute("CREATE TABLE coursedrop (course_combo text, Count integer)")
-        cursor.executemany("INSERT INTO coursedrop VALUES (?,?)",postList)
-        cursor.execute("SELECT course_combo, SUM(Count) FROM coursedrop GROUP BY course_combo")
-        postQry = cursor.fetchall()
-        postEntropy = shannonEntropy(postQry)
-        postCount = 0
-        for item in postQry:
-            postCount += item[1]
-        changeVals = []
-        for m in postQry:
-            mList = list(m[0])
-            #print mList
-            oldString = ""
-            for slot in range(len(mList)):
-                if slot == i:
-                    oldString += '1'
-                else:
-                    oldString += mList[slot]
-            if m[1]>=k:
-                changeVals.append(oldString)
-            elif (m[0] in nonUniqueList):
-                changeVals.append(oldString)
+        postEntropy, changeCombos = comboDropEval(preList, 1 << i, k, nonUniqueSet)
+        changeVals = [comboEncode(combo, width) for combo in changeCombos]
         if len(changeVals)>0:
             postEntList.append((i,preEntropy-postEntropy,changeVals))
     if len(postEntList) == 0:
@@ -870,17 +1698,132 @@ def optimumDrop(cursor, tableName, userVar, k, nonUniqueList, nComb=1):
             low = n
     return low
 
+def comboDropEval(preList, dropMask, k, nonUniqueSet):
+    """
+    preList: list of tuples (course_combo bitset, count) for the flagged users
+    dropMask: int, bitset of the course positions to drop
+    k: int, minimum cell size
+    nonUniqueSet: set of course_combo bitsets already cleared for k-anonymity
+    regroups preList in memory as if the courses in dropMask were dropped,
+    returns the entropy after the drop and the list of combos in preList that
+    lose a course and end up in a group of at least k or in a cleared combo
+    """
+    postCounts = collections.defaultdict(int)
+    for combo, count in preList:
+        postCounts[combo & ~dropMask] += count
+    postEntropy = shannonEntropy(postCounts.items())
+    changeCombos = []
+    for combo, count in preList:
+        postCombo = combo & ~dropMask
+        if combo != postCombo and (postCounts[postCombo]>=k or postCombo in nonUniqueSet):
+            changeCombos.append(combo)
+    return postEntropy, changeCombos
+
+def optimumMultiDrop(cursor, tableName, userVar, k, nonUniqueList, nComb=2, maxIter=None, maxSeconds=None):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of main table
+    userVar: string, name of userid var
+    k: int, minimum cell size
+    nonUniqueList: list of course_combo values already cleared for k-anonymity
+    nComb: int, number of courses to drop together, default 2
+    maxIter: int, optional, maximum number of course sets to evaluate
+    maxSeconds: float, optional, time budget for the search
+    multi-course version of optimumDrop. Finds the set of nComb courses with
+    the lowest entropy loss among sets that let at least one flagged combo
+    reach k (or a cleared combo), ties going to the first set in
+    itertools.combinations order. Only courses taken by a flagged user are
+    tried. The search is depth first, starting from a greedy solution when
+    nComb is above 1, and skips any partial set whose loss already exceeds
+    the best set found, as dropping more courses can only merge groups
+    further and never lowers the loss. maxIter counts every set evaluated,
+    the greedy ones too. If a budget runs out, the best set so far is
+    returned
+    returns (tuple of positions in courseList, entropy delta, changeVals), or []
+    """
+    qry = courseUserQry(cursor, tableName, userVar, 'True')
+    if len(qry)==0:
+        return qry
+    startTime = datetime.datetime.now()
+    width = comboWidth(qry[0][0])
+    preList = [(comboDecode(row[0]), row[1]) for row in qry]
+    nonUniqueSet = set(comboDecode(val) for val in nonUniqueList)
+    uniqueBits = 0
+    for row in preList:
+        uniqueBits |= row[0]
+    positions = [i for i in range(uniqueBits.bit_length()) if uniqueBits >> i & 1]
+    nComb = min(nComb, len(positions))
+    preEntropy = shannonEntropy(preList)
+    state = {'best': [], 'evals': 0, 'stop': False}
+    def evaluate(dropMask):
+        # every evaluation counts toward maxIter/maxSeconds, seed included
+        postEntropy, changeCombos = comboDropEval(preList, dropMask, k, nonUniqueSet)
+        state['evals'] += 1
+        if maxIter is not None and state['evals'] >= maxIter:
+            state['stop'] = True
+        if maxSeconds is not None and (datetime.datetime.now()-startTime).total_seconds() >= maxSeconds:
+            state['stop'] = True
+        return preEntropy-postEntropy, changeCombos
+    # greedy seed, gives the depth first search a tight bound from the start.
+    # for a single course the search below is the same pass, so no seed
+    if nComb > 1:
+        greedyDrops = ()
+        greedyMask = 0
+        for step in range(nComb):
+            stepBest = None
+            for pos in positions:
+                if state['stop']:
+                    break
+                if pos in greedyDrops:
+                    continue
+                loss, changeCombos = evaluate(greedyMask | 1 << pos)
+                if stepBest is None or loss < stepBest[1]:
+                    stepBest = (pos, loss, changeCombos)
+            if state['stop'] and step < nComb-1 or stepBest is None:
+                break
+            greedyDrops = tuple(sorted(greedyDrops+(stepBest[0],)))
+            greedyMask |= 1 << stepBest[0]
+        if len(greedyDrops) == nComb and len(stepBest[2]) > 0:
+            state['best'] = (greedyDrops, stepBest[1], stepBest[2])
+    def search(start, drops, dropMask):
+        for idx in range(start, len(positions)-(nComb-len(drops))+1):
+            if state['stop']:
+                return
+            newDrops = drops+(positions[idx],)
+            newMask = dropMask | 1 << positions[idx]
+            loss, changeCombos = evaluate(newMask)
+            best = state['best']
+            if best and loss > best[1]:
+                continue
+            if len(newDrops) == nComb:
+                if len(changeCombos) > 0 and (not best or loss < best[1] or (loss == best[1] and newDrops < best[0])):
+                    state['best'] = (newDrops, loss, changeCombos)
+            else:
+                search(idx+1, newDrops, newMask)
+    search(0, (), 0)
+    totalSets = 1
+    for j in range(nComb):
+        totalSets = totalSets*(len(positions)-j)/(j+1)
+    if state['stop']:
+        print "search budget reached, returning best drop set found so far"
+    print "evaluated "+str(state['evals'])+" course sets, "+str(totalSets)+" combinations of "+str(nComb)
+    timeReport("optimumMultiDrop", state['evals'], startTime, "course sets")
+    best = state['best']
+    if not best:
+        return []
+    return (best[0], best[1], [comboEncode(combo, width) for combo in best[2]])
+
 def courseDropper(cursor, tableName, courseVar, courseName, changeVals, courseDict={}):
     """
     courseName: string, name of course to be dropped
-    changeVals: list of strings, values of course_combo to drop
+    changeVals: list, values of course_combo to drop
     courseDict: dictionary of courses and running tally of rows dropped
     drops course record where course equals courseName
     AND uniqUserFlag = "True"
     """
     delCount = 0
     for val in changeVals:
-        cursor.execute("SELECT SUM(Count) FROM "+tableName+" WHERE ("+courseVar+" = '"+courseName+"' AND uniqUserFlag = 'True' AND course_combo = '"+val+"')")
+        cursor.execute("SELECT SUM(Count) FROM "+tableName+" WHERE ("+courseVar+" = ? AND uniqUserFlag = 'True' AND course_combo = ?)", (courseName, val))
         qry = cursor.fetchall()
         if (qry[0][0]): delCount += qry[0][0]
         else: return courseDict
@@ -892,8 +1835,9 @@ def courseDropper(cursor, tableName, courseVar, courseName, changeVals, courseDi
     #if confirm == 'n':
     #    return
     #elif confirm == 'y':
-    for val in changeVals:
-        cursor.execute("DELETE FROM "+tableName+" WHERE ("+courseVar+" = '"+courseName+"' AND uniqUserFlag = 'True' AND course_combo = '"+val+"')")
+    since = statsStamp(cursor)
+    cursor.executemany("DELETE FROM "+tableName+" WHERE ("+courseVar+" = ? AND uniqUserFlag = 'True' AND course_combo = ?)", [(courseName, val) for val in changeVals])
+    statsInvalidate(cursor, tableName, None, since)
     #else:
     #    print "invalid choice, exiting function"
     return courseDict
@@ -913,7 +1857,14 @@ def contCensor(cursor, tableName, varName1, varName2):
     th = int, k, minimum group size
     similar to contSwap, only does it for all rows with a "False" export_flag
     """
-    cursor.execute('UPDATE '+tableName+' SET '+varName1+'_DI = '+varName2+' WHERE export_flag = "False"')
+    since = statsStamp(cursor)
+    value = valueExpr(cursor, tableName, varName2)
+    if isDictEncoded(cursor, tableName, varName1+"_DI"):
+        cursor.execute("SELECT DISTINCT "+value+" FROM "+tableName+" WHERE export_flag = 'False'")
+        dictCodes(cursor, tableName, varName1+"_DI", colToList(cursor.fetchall()))
+        value = "(SELECT code FROM "+dictTable(tableName, varName1+"_DI")+" WHERE value = "+value+")"
+    cursor.execute("UPDATE "+tableName+" SET "+varName1+"_DI = "+value+" WHERE export_flag = 'False'")
+    statsInvalidate(cursor, tableName, [varName1+"_DI"], since)
     
 def censor(cursor, tableName, varName, value=""):
     """
@@ -923,7 +1874,373 @@ def censor(cursor, tableName, varName, value=""):
     sets value of given variable to specified value
     default blank, for rows with export_flag = 'False'
     """
+    since = statsStamp(cursor)
     cursor.execute("UPDATE "+tableName+" SET "+varName+" = '"+value+"' WHERE export_flag = 'False'")
+    statsInvalidate(cursor, tableName, [varName], since)
+
+######################
+# Parallel processing by course, with pp
+# workers read their course from the database
+# file, the writes are done by the caller
+######################
+
+def dbFile(cursor):
+    """
+    cursor: sqlite3 cursor object
+    returns the path of the database file behind cursor, raises ValueError
+    for an in-memory database, which worker processes cannot open
+    """
+    cursor.execute("Pragma database_list")
+    for row in cursor.fetchall():
+        if row[1] == "main":
+            if not row[2]:
+                raise ValueError("parallel mode needs a database file, not an in-memory database")
+            return row[2]
+
+def courseParallel(cursor, tableName, courseVar, worker, args=(), ncpus="autodetect"):
+    """
+    cursor: sqlite3 cursor object, on a database file
+    tableName: string, name of table
+    courseVar: string, name of course variable to shard by
+    worker: function, called once per course as
+            worker(dbPath, tableName, courseVar, course, *args), e.g. utilShard,
+            where course is the value stored in courseVar, its code when
+            courseVar is dictionary encoded, so the worker can select it
+            with courseVar IS ? on the index.
+            pp ships its source to the worker processes, so it may only use
+            the sqlite3 and math modules, not other functions of this file
+    args: tuple, extra arguments for worker
+    ncpus: int, number of worker processes, default one per core
+    indexes courseVar and commits pending changes, then runs worker for every
+    course in a pp job server. returns dict of course value to the worker's
+    result
+    """
+    pp = optionalImport("pp", "courseParallel")
+    try: varIndex(cursor, tableName, courseVar)
+    except: pass
+    cursor.connection.commit()
+    dbPath = dbFile(cursor)
+    cursor.execute("SELECT DISTINCT "+courseVar+" FROM "+tableName)
+    courses = colToList(cursor.fetchall())
+    names = dict((course, course) for course in courses)
+    if isDictEncoded(cursor, tableName, courseVar):
+        names.update((code, value) for value, code in dictCodes(cursor, tableName, courseVar, []).iteritems())
+    startTime = datetime.datetime.now()
+    server = pp.Server(ncpus)
+    print "pp workers: "+str(server.get_ncpus())
+    results = {}
+    try:
+        jobs = [(course, server.submit(worker, (dbPath, tableName, courseVar, course)+tuple(args), (), ("sqlite3", "math"))) for course in courses]
+        for course, job in jobs:
+            result = job()
+            if result is None:
+                raise RuntimeError("pp worker "+worker.__name__+" failed for "+str(names[course]))
+            results[names[course]] = result
+    finally:
+        server.destroy()
+    timeReport(worker.__name__+" on "+str(len(courses))+" courses", len(courses), startTime, "courses")
+    return results
+
+def utilShard(dbPath, tableName, courseVar, course, varList, batchSize=50000):
+    """
+    pp worker for utilParallel, varList is a list of (var name, dict of code
+    to value or None), the dict for dictionary encoded variables. Counts all
+    variables of one course in one scan, like utilStats, and returns dict of
+    var name to (dict of value to count, n, mean, sum of squared deviations),
+    the last three over the values that convert to float
+    """
+    conn = sqlite3.connect(dbPath)
+    c = conn.cursor()
+    counts = [{} for var in varList]
+    cols = range(len(varList))
+    c.execute("SELECT "+", ".join(var[0] for var in varList)+", Count FROM "+tableName+" WHERE "+courseVar+" IS ?", (course,))
+    while True:
+        rows = c.fetchmany(batchSize)
+        if not rows:
+            break
+        for row in rows:
+            n = row[-1]
+            for i in cols:
+                counts[i][row[i]] = counts[i].get(row[i], 0)+n
+    conn.close()
+    stats = {}
+    for i, var in enumerate(varList):
+        if var[1] is not None:
+            decoded = {}
+            for code, count in counts[i].iteritems():
+                value = var[1].get(code)
+                decoded[value] = decoded.get(value, 0)+count
+            counts[i] = decoded
+        n = 0
+        mean = 0.0
+        m2 = 0.0
+        for value, count in counts[i].iteritems():
+            try: num = float(value)
+            except: continue
+            if math.isnan(num):
+                continue
+            n += count
+            delta = num-mean
+            mean += delta*count/n
+            m2 += delta*(num-mean)*count
+        stats[var[0]] = (counts[i], n, mean, m2)
+    return stats
+
+def utilParallel(cursor, tableName, varList, courseVar="course_id", ncpus="autodetect"):
+    """
+    cursor: sqlite cursor object, on a database file
+    tableName: string, name of table
+    varList: list of tuples, form of (col number, var name), var name unicode
+    courseVar: string, name of course variable, default 'course_id'
+    ncpus: int, number of worker processes, default one per core
+    utility statistics computed per course by pp workers and then merged,
+    returns dict of var name to (entropy, mean, SD), mean and SD over the
+    values that convert to float, None if there are none. Encoded variables
+    are counted by their values, not their codes
+    """
+    codeList = []
+    for var in varList:
+        if isDictEncoded(cursor, tableName, var[1]):
+            codeList.append((var[1], dict((code, value) for value, code in dictCodes(cursor, tableName, var[1], []).iteritems())))
+        else:
+            codeList.append((var[1], None))
+    shards = courseParallel(cursor, tableName, courseVar, utilShard, (codeList,), ncpus)
+    utils = {}
+    for var in varList:
+        counts = collections.defaultdict(int)
+        n = 0
+        mean = 0.0
+        m2 = 0.0
+        for stats in shards.itervalues():
+            shardCounts, shardN, shardMean, shardM2 = stats[var[1]]
+            for value, count in shardCounts.iteritems():
+                counts[value] += count
+            if shardN == 0:
+                continue
+            delta = shardMean-mean
+            m2 += shardM2+delta*delta*n*shardN/(n+shardN)
+            mean += delta*shardN/(n+shardN)
+            n += shardN
+        if n == 0:
+            utils[var[1]] = (shannonEntropy(counts.items()), None, None)
+        else:
+            utils[var[1]] = (shannonEntropy(counts.items()), mean, math.sqrt(m2/n))
+    return utils
+
+######################
+# Dictionary-encoded columns
+######################
+
+def dictTable(tableName, varName):
+    """
+    returns the name of the dictionary table of varName, see dictEncode
+    """
+    return tableName+"_"+varName+"_dict"
+
+def isDictEncoded(cursor, tableName, varName):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varName: string, name of variable
+    returns True if varName is stored as dictionary codes
+    """
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND lower(name) = lower(?)", (dictTable(tableName, varName),))
+    return cursor.fetchall()[0][0] > 0
+
+def dictEncode(cursor, tableName, varName):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varName: string, name of QI variable to encode
+    replaces the text values of varName with small integer codes, each value
+    is kept once in the table tableName_varName_dict (code, value). Grouping
+    and kkeyUpdate then work on integers, dataUpdate on the variable only
+    rewrites the dictionary, and selUnique, nullMarker and csvExport still see
+    the values. Nulls stay NULL. The values of an encoded variable must be
+    changed with dataUpdate, not with raw SQL. The column keeps its place in
+    the table (see colReplace)
+    """
+    if isDictEncoded(cursor, tableName, varName):
+        return
+    since = statsStamp(cursor)
+    dictName = dictTable(tableName, varName)
+    cursor.execute("CREATE TABLE "+dictName+" (code integer PRIMARY KEY, value text UNIQUE)")
+    cursor.execute("INSERT INTO "+dictName+" (value) SELECT DISTINCT "+varName+" FROM "+tableName+" WHERE "+varName+" IS NOT NULL ORDER BY "+varName)
+    addColumn(cursor, tableName, varName+"_code", "integer")
+    cursor.execute("UPDATE "+tableName+" SET "+varName+"_code = (SELECT code FROM "+dictName+" WHERE value = "+tableName+"."+varName+")")
+    colReplace(cursor, tableName, varName, varName+"_code")
+    statsInvalidate(cursor, dictName, None, since)
+    statsInvalidate(cursor, tableName, [varName, varName+"_code"], since)
+
+def dictDecode(cursor, tableName, varName):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varName: string, name of encoded variable
+    writes the values back into varName as text and drops the dictionary
+    """
+    if not isDictEncoded(cursor, tableName, varName):
+        return
+    since = statsStamp(cursor)
+    addColumn(cursor, tableName, varName+"_text")
+    cursor.execute("UPDATE "+tableName+" SET "+varName+"_text = "+valueExpr(cursor, tableName, varName))
+    colReplace(cursor, tableName, varName, varName+"_text")
+    cursor.execute("DROP TABLE "+dictTable(tableName, varName))
+    statsInvalidate(cursor, dictTable(tableName, varName), None, since)
+    statsInvalidate(cursor, tableName, [varName, varName+"_text"], since)
+
+def dictCodes(cursor, tableName, varName, values):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varName: string, name of encoded variable
+    values: list of values
+    adds any of values missing from the dictionary of varName,
+    returns dict of value to code for the whole dictionary
+    """
+    since = statsStamp(cursor)
+    dictName = dictTable(tableName, varName)
+    cursor.executemany("INSERT OR IGNORE INTO "+dictName+" (value) VALUES (?)", [(value,) for value in set(values) if value is not None])
+    statsInvalidate(cursor, dictName, None, since)
+    cursor.execute("SELECT value, code FROM "+dictName)
+    return dict(cursor.fetchall())
+
+def dictRemap(cursor, tableName, varName, catMap):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varName: string, name of encoded variable
+    catMap: dict, mapping of old values to new
+    applies catMap to the dictionary of varName. Rows are only rewritten
+    where two values are merged into one, those rows get the lowest code,
+    or where a value is mapped to None, those rows are set to NULL as they
+    would be in a plain column
+    """
+    since = statsStamp(cursor)
+    dictName = dictTable(tableName, varName)
+    cursor.execute("SELECT code, value FROM "+dictName+" ORDER BY code")
+    newDict = {}
+    merges = []
+    for code, value in cursor.fetchall():
+        newValue = catMap.get(value, value)
+        if newValue is None:
+            merges.append((None, code))
+        elif newValue in newDict:
+            merges.append((newDict[newValue], code))
+        else:
+            newDict[newValue] = code
+    cursor.executemany("UPDATE "+tableName+" SET "+varName+" = ? WHERE "+varName+" = ?", merges)
+    cursor.execute("DELETE FROM "+dictName)
+    cursor.executemany("INSERT INTO "+dictName+" VALUES (?, ?)", [(code, value) for value, code in newDict.iteritems()])
+    statsInvalidate(cursor, dictName, None, since)
+    statsInvalidate(cursor, tableName, [varName], since)
+
+def valueExpr(cursor, tableName, varName):
+    """
+    returns the sql expression for the values of varName, a lookup in the
+    dictionary when it is encoded, otherwise just varName
+    """
+    if isDictEncoded(cursor, tableName, varName):
+        return "(SELECT value FROM "+dictTable(tableName, varName)+" WHERE code = "+tableName+"."+varName+")"
+    return varName
+
+def keyExpr(cursor, tableName, varName, qualify=False):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varName: string, name of variable
+    qualify: bool, optional, prefix varName with tableName, default False
+    returns the sql expression that groups varName with nulls as 'NULL'. In a
+    plain column NULL and the text 'NULL' (what contSwap writes for rows
+    without a country) fall in the same group, so in an encoded column NULL
+    takes the code of 'NULL' if the dictionary has one
+    """
+    col = varName
+    if qualify:
+        col = tableName+"."+varName
+    if isDictEncoded(cursor, tableName, varName):
+        cursor.execute("SELECT code FROM "+dictTable(tableName, varName)+" WHERE value = 'NULL'")
+        code = cursor.fetchall()
+        if code:
+            return "IFNULL("+col+","+str(code[0][0])+")"
+    return "IFNULL("+col+",'NULL')"
+
+def colCopy(cursor, tableName, varName, newVarName):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varName: string, name of variable to copy
+    newVarName: string, name of the copy, created if needed
+    the copy is encoded the same way as varName, an encoded variable is
+    copied as codes along with its own copy of the dictionary
+    """
+    since = statsStamp(cursor)
+    if isDictEncoded(cursor, tableName, varName):
+        if colExists(cursor, tableName, newVarName) and not isDictEncoded(cursor, tableName, newVarName):
+            addColumn(cursor, tableName, newVarName+"_code", "integer")
+            colReplace(cursor, tableName, newVarName, newVarName+"_code")
+        if not colExists(cursor, tableName, newVarName):
+            addColumn(cursor, tableName, newVarName, "integer")
+            try: varIndex(cursor, tableName, newVarName)
+            except: pass
+        newDict = dictTable(tableName, newVarName)
+        try:
+            cursor.execute("DROP TABLE "+newDict)
+        except:
+            pass
+        cursor.execute("CREATE TABLE "+newDict+" (code integer PRIMARY KEY, value text UNIQUE)")
+        cursor.execute("INSERT INTO "+newDict+" SELECT code, value FROM "+dictTable(tableName, varName))
+    else:
+        dictDecode(cursor, tableName, newVarName)
+        try:
+            addColumn(cursor, tableName, newVarName)
+            varIndex(cursor, tableName, newVarName)
+        except:
+            pass
+    cursor.execute("UPDATE "+tableName+" SET "+newVarName+" = "+varName)
+    statsInvalidate(cursor, dictTable(tableName, newVarName), None, since)
+    statsInvalidate(cursor, tableName, [newVarName], since)
+
+def colReplace(cursor, tableName, varName, newVarName):
+    """
+    cursor: sqlite3 cursor object
+    tableName: string, name of table
+    varName: string, name of variable to replace
+    newVarName: string, name of variable with the new values, dropped
+    puts the values and type of newVarName in place of varName. The table is
+    rebuilt with its columns in the same order and the same rowids, so the
+    column numbers from qiPicker (and any varList made from them) still
+    hold. The indexes are made again, with one on varName
+    """
+    since = statsStamp(cursor)
+    cursor.execute("Pragma table_info("+tableName+")")
+    columns = cursor.fetchall()
+    newType = [col[2] for col in columns if col[1].lower() == newVarName.lower()][0]
+    colDefs = []
+    selectItems = []
+    for col in columns:
+        if col[1].lower() == newVarName.lower():
+            continue
+        if col[1].lower() == varName.lower():
+            colDefs.append(col[1]+" "+newType)
+            selectItems.append(newVarName)
+        else:
+            colDefs.append(col[1]+" "+col[2])
+            selectItems.append(col[1])
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND lower(tbl_name) = lower(?) AND sql IS NOT NULL", (tableName,))
+    indexes = colToList(cursor.fetchall())
+    newTable = tableName+"_rebuild"
+    cursor.execute("CREATE TABLE "+newTable+" ("+", ".join(colDefs)+")")
+    cursor.execute("INSERT INTO "+newTable+" (rowid, "+", ".join([col[1] for col in columns if col[1].lower() != newVarName.lower()])+") SELECT rowid, "+", ".join(selectItems)+" FROM "+tableName)
+    cursor.execute("DROP TABLE "+tableName)
+    cursor.execute("ALTER TABLE "+newTable+" RENAME TO "+tableName)
+    # indexes on newVarName are gone with it
+    for sql in indexes:
+        try: cursor.execute(sql)
+        except: pass
+    try: varIndex(cursor, tableName, varName)
+    except: pass
+    statsInvalidate(cursor, tableName, [varName, newVarName], since)
 
 ######################
 # Misc. Helper functions
@@ -937,26 +2254,45 @@ def dataUpdate(cursor,tableName,varName,catMap, newVar=False, newVarName = ''):
     catMap: dict, mapping of old values to new
     newVar: bool, optional, flag for if updated variable is different from key variable
     newVarName: if newVar==True, must provide name of target variable
+    loads catMap into a temporary table "catmap" and applies it to every
+    row in a single UPDATE, values are bound so quotes are safe
+    dictionary encoded variables (see dictEncode) are mapped through their
+    codes, and an encoded variable updated in place only has its dictionary
+    rewritten
     """
+    since = statsStamp(cursor)
     try: varIndex(cursor, tableName, varName)
     except: pass
-    count = 0
     if newVar:
         try: varIndex(cursor, tableName, newVarName)
         except: pass
-        for cat in catMap:
-            #if count == 100:
-            #    return
-            #print count
-            #count += 1
-            cursor.execute('UPDATE '+tableName+' SET '+newVarName+' = "'+catMap[cat]+ '" WHERE '+varName+' = "'+cat+'"')
+        target = newVarName
     else:
-        for cat in catMap:
-            #if count == 100:
-            #    return
-            #print count
-            #count += 1
-            cursor.execute('UPDATE '+tableName+' SET '+varName+' = "'+catMap[cat]+ '" WHERE '+varName+' = "'+cat+'"')
+        target = varName
+    if target == varName and isDictEncoded(cursor, tableName, varName):
+        dictRemap(cursor, tableName, varName, catMap)
+        return
+    items = catMap.items()
+    oldType = "text"
+    newType = "text"
+    if isDictEncoded(cursor, tableName, varName):
+        cursor.execute("SELECT value, code FROM "+dictTable(tableName, varName))
+        codes = dict(cursor.fetchall())
+        items = [(codes[old], new) for old, new in items if old in codes]
+        oldType = "integer"
+    if isDictEncoded(cursor, tableName, target):
+        codes = dictCodes(cursor, tableName, target, [new for old, new in items])
+        items = [(old, codes.get(new)) for old, new in items]
+        newType = "integer"
+    try:
+        cursor.execute("DROP TABLE temp.catmap")
+    except:
+        pass
+    cursor.execute("CREATE TEMP TABLE catmap (oldVal "+oldType+" PRIMARY KEY, newVal "+newType+")")
+    cursor.executemany("INSERT OR REPLACE INTO catmap VALUES (?, ?)", items)
+    cursor.execute("UPDATE "+tableName+" SET "+target+" = (SELECT newVal FROM catmap WHERE oldVal = "+tableName+"."+varName+") WHERE "+varName+" IN (SELECT oldVal FROM catmap)")
+    cursor.execute("DROP TABLE temp.catmap")
+    statsInvalidate(cursor, tableName, [target], since)
 
 def colToList(queryResult):
     """
@@ -967,7 +2303,55 @@ def colToList(queryResult):
     for a in queryResult:
         returnList.append(a[0])
     return returnList
-    
+
+def comboEncode(mask, courseCount):
+    """
+    mask: int, bitset of courses, bit i set means the user took courseList[i]
+    courseCount: int, number of courses in courseList
+    returns the value stored in course_combo, a signed 64-bit integer when there
+    are up to 64 courses, otherwise a fixed-width big-endian blob
+    """
+    if courseCount <= 64:
+        if mask >= 2**63:
+            mask -= 2**64
+        return mask
+    hexMask = '%x' % mask
+    return buffer(hexMask.zfill(((courseCount+7)/8)*2).decode('hex'))
+
+def comboDecode(value):
+    """
+    value: course_combo value as stored by comboEncode
+    returns the bitset as a non-negative int
+    """
+    if isinstance(value, (int, long)):
+        return value & (2**64-1)
+    if isinstance(value, basestring):
+        return int(value) & (2**64-1)
+    return int(str(value).encode('hex') or '0', 16)
+
+def comboWidth(value):
+    """
+    value: course_combo value as stored by comboEncode
+    returns the number of courses the encoding has room for, to pass back
+    to comboEncode
+    """
+    if isinstance(value, buffer):
+        return len(value)*8
+    return 64
+
+def timeReport(label, rowCount, startTime, unit="rows"):
+    """
+    label: string, description of the step that was timed
+    rowCount: int, number of rows processed by the step
+    startTime: datetime object, taken when the step started
+    unit: string, what rowCount counts, default "rows"
+    prints elapsed time and throughput in units/sec, returns elapsed seconds
+    """
+    elapsed = (datetime.datetime.now()-startTime).total_seconds()
+    rate = rowCount/elapsed if elapsed > 0 else float(rowCount)
+    print label+": %.2f sec, %.0f %s/sec" % (elapsed, rate, unit)
+    return elapsed
+
 
 #######################
 #
@@ -987,9 +2371,9 @@ def csvExport(cursor, tableName, outFileName):
     selectItems = ''
     headers = []
     for var in varList[:-1]:
-        selectItems += str(var[1])+", "
+        selectItems += valueExpr(cursor, tableName, str(var[1]))+", "
         headers.append(str(var[1]))
-    selectItems += str(varList[-1][1])
+    selectItems += valueExpr(cursor, tableName, str(varList[-1][1]))
     headers.append(str(varList[-1][1]))
     with open(outFileName,"w") as csvOutFile:
         fileWriter = csv.writer(csvOutFile)
@@ -0,0 +1,795 @@
+##################################
+#
+# title: de_id_pandas.py
+#
+# desc: In-memory version of the helpers in de_id_functions.py
+#       for datasets that fit in RAM. The functions keep the same
+#       names and arguments, but the "cursor" is a FrameStore
+#       (see dbOpen), a dict of table name to pandas DataFrame,
+#       and group counts, mappings and suppression are done with
+#       vectorized numpy/pandas operations instead of SQL.
+#       Tables can be moved between the two backends with
+#       tableLoad and tableSave
+#
+##################################
+
+
+import datetime, sqlite3, itertools, collections
+import numpy as np
+import pandas as pd
+from de_id_functions import histSuppression, comboEncode, comboDecode, timeReport, uniqUserSplit, contSwapMap
+from de_id_functions import countryLookup, contLookup, specialCodes, dateLevelNames
+import de_id_functions
+
+########################
+# Table store, stands in for the sqlite cursor
+#######################
+
+class FrameStore(dict):
+    """
+    dict of table name to pandas DataFrame, passed as the cursor argument
+    db: string, name of sqlite file that tableLoad and dbClose use, optional
+    """
+    def __init__(self, db=None):
+        dict.__init__(self)
+        self.db = db
+
+def dbOpen(db=None):
+    """
+    db: string, name of sqlite file to read tables from / write tables to
+    on close, optional. Nothing is read until tableLoad is called
+    returns an empty FrameStore
+    """
+    return FrameStore(db)
+
+def dbClose(cursor, closeFlag=True):
+    """
+    cursor: FrameStore
+    closeFlag: bool, if True the tables are dropped from memory afterwards
+    writes every table back to the sqlite file given to dbOpen, if any
+    """
+    if cursor.db is not None:
+        for tableName in cursor.keys():
+            tableSave(cursor, tableName)
+    if closeFlag:
+        cursor.clear()
+
+def tableLoad(cursor, tableName, db=None):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    db: string, name of sqlite file, default is the one given to dbOpen
+    reads a table made by the sqlite backend into the store, dictionary
+    encoded columns are read as their values
+    """
+    conn = sqlite3.connect(db or cursor.db)
+    try:
+        c = conn.cursor()
+        c.execute("Pragma table_info("+tableName+")")
+        cols = [col[1] for col in c.fetchall()]
+        exprs = [de_id_functions.valueExpr(c, tableName, col)+" AS "+col for col in cols]
+        df = pd.read_sql("SELECT "+", ".join(exprs)+" FROM "+tableName, conn)
+    finally:
+        conn.close()
+    df["Count"] = df["Count"].astype(np.int64)
+    cursor[tableName] = df
+
+def tableSave(cursor, tableName, db=None):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    db: string, name of sqlite file, default is the one given to dbOpen
+    writes the table to sqlite, replacing any table with the same name, so
+    the functions in de_id_functions.py can carry on from there. Columns are
+    written as values, so the dictionaries of the old table are dropped
+    """
+    conn = sqlite3.connect(db or cursor.db)
+    try:
+        c = conn.cursor()
+        for col in cursor[tableName].columns:
+            if de_id_functions.isDictEncoded(c, tableName, col):
+                c.execute("DROP TABLE "+de_id_functions.dictTable(tableName, col))
+        cursor[tableName].to_sql(tableName, conn, if_exists="replace", index=False)
+        conn.commit()
+    finally:
+        conn.close()
+
+########################
+# Simple table operations
+#######################
+
+def addColumn(cursor, tableName, varName, varType="text"):
+    """
+    raises ValueError if the column already exists, like ALTER TABLE does
+    """
+    if colExists(cursor, tableName, varName):
+        raise ValueError("duplicate column name: "+varName)
+    cursor[tableName][varName] = None
+
+def selUnique(cursor, tableName, varName):
+    df = cursor[tableName]
+    codes, uniques = groupCodes(df, [varName])
+    sums = np.bincount(codes, weights=df["Count"].values, minlength=len(uniques))
+    return sorted(zip([u[0] for u in uniques], [int(s) for s in sums]))
+
+def simpleUpdate(cursor, tableName, varName, value):
+    cursor[tableName][varName] = value
+
+def colExists(cursor, tableName, varName):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varName: string, name of variable to look for
+    returns True if tableName has a column called varName
+    """
+    return varName.lower() in [str(col).lower() for col in cursor[tableName].columns]
+
+def varIndex(cursor, tableName, varName):
+    """
+    no indexes are needed in memory, kept so calls from the notebook still work
+    """
+    pass
+
+def groupCodes(df, varList):
+    """
+    df: pandas DataFrame
+    varList: list of column names
+    returns an int array with the group number of each row for the combination
+    of the columns in varList, and the list of value tuples for each group
+    number. Nulls form their own group, with None as the value
+    """
+    codes = np.zeros(len(df), dtype=np.int64)
+    uniques = [()]
+    for var in varList:
+        colCodes, colUniques = pd.factorize(df[var].values)
+        colUniques = colUniques.tolist()
+        if (colCodes == -1).any():
+            colCodes = colCodes.copy()
+            colCodes[colCodes == -1] = len(colUniques)
+            colUniques.append(None)
+        codes, combined = pd.factorize(codes*len(colUniques)+colCodes)
+        uniques = [uniques[c/len(colUniques)]+(colUniques[c%len(colUniques)],) for c in combined]
+    return codes, uniques
+
+##################
+# Functions that need to be done for a new dataset, but not thereafter
+#################
+
+def sourceLoad(cursor, fname, tableName, batchSize=50000):
+    """
+    cursor: FrameStore
+    fname: string, file name/path for loading, .csv format
+    batchSize: int, number of rows parsed at a time, default 50000
+    reads a .csv file into the store, every column as text as in the sqlite
+    version, plus kkey and Count
+    CAUTION: will replace any existing table with same name
+    """
+    startTime = datetime.datetime.now()
+    chunks = pd.read_csv(fname, dtype=object, na_filter=False, chunksize=batchSize)
+    df = pd.concat(list(chunks), ignore_index=True)
+    df["kkey"] = None
+    df["Count"] = np.ones(len(df), dtype=np.int64)
+    cursor[tableName] = df
+    timeReport("loaded "+str(len(df))+" rows into "+tableName, len(df), startTime)
+
+def countryNamer(cursor, tableName, countryCode):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    countryCode: string, name of variable containing 2-char alpha country codes
+    maps the unique country codes to country names where possible, into countryCode+"_cname"
+    """
+    qry = selUnique(cursor,tableName,countryCode)
+    countries = countryLookup()
+    cnameDict = {}
+    for row in qry:
+        if row[0] in countries:
+            cnameDict[row[0]] = countries[row[0]][0]
+        else:
+            if row[0] not in specialCodes:
+                print "no country for cc=%s" % (row[0],)
+            cnameDict[row[0]] = row[0]
+    try: addColumn(cursor,tableName,countryCode+"_cname")
+    except: simpleUpdate(cursor,tableName,countryCode+"_cname","NULL")
+    dataUpdate(cursor,tableName,countryCode,cnameDict, True, countryCode+"_cname")
+
+def contImport(cursor, tableName, inFileName, varName1, varName2='continent'):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varName1: string, name of variable containing country names
+    varName2: string, name of variable to write continent names to
+              default value is 'continent'
+    inFileName: string, name of file to read from, None for the built-in table
+    maps the pickled country to continent dictionary onto varName1
+    """
+    contDict = contLookup(inFileName)
+    try: addColumn(cursor,tableName,varName2)
+    except: simpleUpdate(cursor,tableName,varName2,"NULL")
+    dataUpdate(cursor, tableName, varName1, contDict, True, varName2)
+
+def idGen(cursor, tableName, varName, prefix):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varName: name of id variable
+    prefix: string, to start username
+    gives every distinct id a sequential id of the format prefix + number
+    (e.g. "MITx147300937") in random order, written to userid_DI. Rows with
+    a null id get a null userid_DI, as in the sqlite version
+    """
+    startTime = datetime.datetime.now()
+    df = cursor[tableName]
+    codes, uniques = groupCodes(df, [varName])
+    length = len(uniques)
+    print "ids: "+str(length)
+    count = len(str(length*10))
+    seq = np.random.permutation(length)+1
+    newIds = np.array([prefix+str(s).zfill(count) for s in seq], dtype=object)
+    newIds[np.array([u[0] is None for u in uniques], dtype=bool)] = None
+    if colExists(cursor, tableName, "userid_DI"):
+        print "userid_DI column already exists, overwriting"
+    df["userid_DI"] = newIds[codes]
+    timeReport("ids assigned", length, startTime, "ids")
+
+########################
+# functions for generalizing
+######################
+
+def contCounts(cursor, tableName, varName1, varName2):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varName1: string, name of variable containing country names
+    varName2: string, name of variable containing continent names
+    returns list of tuples (country, continent, sum of Count), for contSwapMap
+    or contSwap
+    """
+    df = cursor[tableName]
+    codes, uniques = groupCodes(df, [varName1])
+    sums = np.bincount(codes, weights=df["Count"].values, minlength=len(uniques))
+    first = np.unique(codes, return_index=True)[1]
+    continents = df[varName2].values[first].tolist()
+    return [(uniques[i][0], continents[i], int(sums[i])) for i in range(len(uniques))]
+
+def contSwap(cursor, tableName, varName1, varName2, th, countries=None):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varName1: string, name of variable containing country names
+    varName2: string, name of variable containing continent names
+    th = int, k, minimum group size
+    countries: list, optional, result of contCounts, counted here if not given
+    fills varName1+"_DI" with the country, or the continent where the n in
+    the country is lower than th or the country is one of the special codes,
+    'NULL' where there is no country. returns the number of categories after
+    the swap, as counted by selUnique
+    """
+    df = cursor[tableName]
+    if countries is None:
+        countries = contCounts(cursor, tableName, varName1, varName2)
+    print "countries: "+str(len(countries))
+    swapMap = contSwapMap(countries, th)
+    df[varName1+"_DI"] = df[varName1].map(swapMap)
+    df.loc[df[varName1].isnull(), varName1+"_DI"] = 'NULL'
+    catCount = len(selUnique(cursor, tableName, varName1+"_DI"))
+    print "categories after swap: "+str(catCount)
+    return catCount
+
+def tailFinder(cursor, tableName, varName, catSize):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varName: string, name of variable with tails
+    catSize: k, upper bound for category size
+    only works for integers
+    """
+    qry = selUnique(cursor,tableName,varName)
+    itemList = {}
+    keyList = []
+    for i in qry:
+        try:
+            itemList[int(i[0])]=i[1]
+            keyList.append(int(i[0]))
+        except:
+            print "non int value: "+str(i[0])+", skipping"
+    keyList.sort()
+    for j in keyList:
+        if itemList[j] < catSize:
+            print j, itemList[j]
+    a = raw_input("Would you like to trim the tails? (y/n): ")
+    while a not in ['y','n']:
+        a = raw_input("Please choose y(es) or n(o): ")
+    if a=='n':
+        return
+    b = raw_input("High (h), Low (l), or Both (b)?: ")
+    if b == 'b' or b == 'l':
+        low = raw_input("Choose the low tail: ")
+        try: low = int(low)
+        except: "invalid value, must be int"
+        while low not in keyList:
+            low = raw_input("Please choose from the values available: ")
+            low = int(low)
+        print "Low tail for "+varName+": "+str(low)
+    if b=='b' or b=='h':
+        hi = raw_input("Choose the high tail: ")
+        try: hi = int(hi)
+        except: "invalid value, must be int"
+        while hi not in keyList:
+            hi = raw_input("Please choose from the values available: ")
+            hi = int(hi)
+        print "High tail for "+varName+": "+str(hi)
+    tailMap = {}
+    for j in keyList:
+        tailMap[str(j)] = str(j)
+        if (b == 'b' or b == 'l') and j <= low:
+            tailMap[str(j)] = "<= "+str(low)
+        if (b == 'b' or b == 'h') and j >= hi:
+            tailMap[str(j)] = ">= "+str(hi)
+    try:
+        addColumn(cursor,tableName,varName+"_DI")
+    except:
+        print "column "+varName+"_DI"+" already exists, overwriting..."
+        cursor[tableName][varName+"_DI"] = cursor[tableName][varName]
+    dataUpdate(cursor,tableName,varName,tailMap,True,varName+"_DI")
+
+def numBinner(cursor, tableName, varName, bw=5):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varName: string, name of variable containing number to bin
+    bw: int, bin width, default is 5
+    if there are already string or unicode "bins" in the values, they will be preserved
+    """
+    qry = selUnique(cursor, tableName, varName)
+    binMap = {}
+    nums = []
+    for item in qry:
+        try: nums.append(int(item[0]))
+        except: pass
+    minBin = min(nums)
+    for item in qry:
+        try: num = int(item[0])
+        except: continue
+        low = minBin+((num-minBin)/bw)*bw
+        binMap[unicode(item[0])] = str(low)+"-"+str(low+bw-1)
+    choice = raw_input("Copy into (n)ew variable or (o)verwrite?: ")
+    while choice not in ['n','o']:
+        choice = raw_input("Plz choose n or o: ")
+    if choice =='n':
+        try:
+            addColumn(cursor, tableName, varName+"_DI")
+        except:
+            print "column "+varName+"_DI"+" already exists, overwriting..."
+        cursor[tableName][varName+"_DI"] = cursor[tableName][varName]
+        dataUpdate(cursor,tableName,varName,binMap,True,varName+"_DI")
+    else:
+        dataUpdate(cursor,tableName,varName,binMap)
+
+def dateSplit(cursor, tableName, varName, level="day", newVarName=None):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varName: string, name of date variable stored as string
+    level: string, "day", "week", "month", "quarter" or "year", default "day"
+    newVarName: string, optional, name of the new variable, default varName+"_DI"
+    takes date/time stamps formatted "YYYY-MM-DDTxxxxxx" and strips out the date,
+    or generalizes it to the same labels as dateExpr in de_id_functions.py
+    requires the T to denote beginning of the time
+    """
+    if level not in dateLevelNames:
+        raise ValueError("level must be one of "+", ".join(dateLevelNames))
+    if newVarName is None:
+        newVarName = varName+"_DI"
+    if colExists(cursor, tableName, newVarName):
+        print "column "+newVarName+" already exists, overwriting..."
+    df = cursor[tableName]
+    day = df[varName].str.partition("T")[0]
+    if level != "day":
+        dates = pd.to_datetime(day, format="%Y-%m-%d", errors="coerce")
+        if level == "week":
+            thursday = dates - pd.to_timedelta(dates.dt.dayofweek, unit="D") + pd.Timedelta(days=3)
+            label = thursday.dt.strftime("%Y") + "-W" + ((thursday.dt.dayofyear-1)//7+1).map(lambda w: "%02d" % w, na_action="ignore")
+        elif level == "month":
+            label = day.str[:7]
+        elif level == "quarter":
+            label = day.str[:4] + "-Q" + dates.dt.quarter.map(lambda q: "%d" % q, na_action="ignore")
+        else:
+            label = day.str[:4]
+        day = label.where(dates.notnull(), day)
+    df[newVarName] = day
+
+#######################
+# Diagnostic functions
+#######################
+
+def nullMarker(cursor, tableName, varList):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varList: list of tuples, form of (col number, var name), var name unicode
+    generates one column per variable, var name+"_NF", '0' if that record has a
+    missing or null value for the variable, else '1'
+    """
+    df = cursor[tableName]
+    for var in varList:
+        missing = df[var[1]].isin(['', 'NA']).values | df[var[1]].isnull().values
+        df[var[1]+"_NF"] = np.where(missing, '0', '1').astype(object)
+
+def nullWrap(cursor, tableName):
+    """
+    cursor: FrameStore
+    tableName: string, name of table containing vars
+    prompts user to select variables, then creates the 'varname_NF' dummies
+    """
+    varList = qiPicker(cursor, tableName)
+    nullMarker(cursor, tableName, varList)
+
+def iterKcheck(cursor, tableName, k, nullFlag = True):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    k: int, minimum n for groups
+    nullFlag: bool, True means that variables will be chosen
+    by user, and new null vars, etc. generated; default=True
+    iteratively checks for k-anonymity, first with one variable, then two
+    etc. and then as variables are checked, records with null values for the other
+    variables are excluded from future checks. Groups are counted over the
+    records not yet flagged, as in the sqlite version
+    """
+    varList = qiPicker(cursor, tableName)
+    if nullFlag:
+        nullMarker(cursor, tableName, varList)
+    df = cursor[tableName]
+    nullSum = df[varList[0][1]+"_NF"]
+    if len(varList) > 1:
+        nullSum = nullSum.str.cat([df[var[1]+"_NF"] for var in varList[1:]])
+    df["nullSum"] = nullSum
+    nullqry = selUnique(cursor, tableName, "nullSum")
+    if not colExists(cursor, tableName, "kCheckFlag"):
+        df["kCheckFlag"] = "False"
+    counts = df["Count"].values
+    totalStart = datetime.datetime.now()
+    for combo in nullqry:
+        if '0' not in combo[0]: continue
+        tmpVarList = [varList[i] for i in range(len(combo[0])) if combo[0][i] == '1']
+        print "Checking "+combo[0]+"..."
+        print tmpVarList
+        startTime = datetime.datetime.now()
+        codes, uniques = groupCodes(df, [var[1] for var in tmpVarList])
+        unflagged = (df["kCheckFlag"] == 'False').values
+        sums = np.bincount(codes[unflagged], weights=counts[unflagged], minlength=len(uniques))
+        flag = (df["nullSum"] == combo[0]).values & (sums[codes] >= k)
+        df.loc[flag, "kCheckFlag"] = 'True'
+        timeReport("pattern "+combo[0]+", "+str(flag.sum())+" rows flagged", combo[1], startTime)
+    timeReport("all null patterns", sum(combo[1] for combo in nullqry), totalStart)
+
+def kkeyUpdate(cursor, tableName, varList, var="kkey"):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varList: list of tuples, form of (col number, var name), var name unicode
+    gives every distinct combination of the QI variables a compact integer
+    group id in kkey, numbered in sorted order of the values with nulls
+    as 'NULL', the same ids the sqlite version assigns
+    """
+    df = cursor[tableName]
+    codes = np.zeros(len(df), dtype=np.int64)
+    for item in varList:
+        colCodes, colUniques = pd.factorize(df[item[1]].fillna('NULL').values, sort=True)
+        codes, combined = pd.factorize(codes*len(colUniques)+colCodes, sort=True)
+    df[var] = codes+1
+
+def qiPicker(cursor, tableName):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    asks the user to specify the QI columns
+    """
+    columns = list(cursor[tableName].columns)
+    print "Please choose the QI variables from the list below:"
+    for colNum in range(len(columns)):
+        print str(colNum)+". "+columns[colNum]
+    choice = raw_input("Enter your choices by number, separated by commas: ")
+    qiList = choice.split(',')
+    varList = [(int(g),columns[int(g)]) for g in qiList]
+    return varList
+
+def grainSize(cursor, tableName, qiName):
+    """
+    cursor: FrameStore
+    qiName: string, name of variable to check for grain size
+    returns a float, "grain size" as given by n of categories/n of items, smaller
+    value means less granular, bigger "grains"
+    """
+    df = cursor[tableName]
+    codes, uniques = groupCodes(df, [qiName])
+    return float(len(uniques))/len(df)
+
+def genPicker(cursor, tableName, varList):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varList: list of strings corresponding to columns in tableName
+    returns string name of variable to generalize next
+    """
+    b = [(var[1], grainSize(cursor,tableName,var[1])) for var in varList]
+    c = [i[1] for i in b]
+    d = str(b[c.index(max(c))][0])
+    return d
+
+def isTableKanonymous(cursor, tableName, k):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    k: int
+    checks the classes in kkey for k-anonymity, returns bool and supression
+    required for k-anonymity (float btw. 0,1)
+    """
+    hist = classSizeHist(cursor, tableName)
+    supp = histSuppression(hist, k)
+    return supp == 0.0, supp
+
+def classSizeHist(cursor, tableName, var="kkey"):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    var: string, name of the equivalence class variable, default "kkey"
+    returns dict of class size (sum of Count) to number of classes of that size.
+    Only records with kCheckFlag = 'False' are counted when that column exists
+    """
+    df = cursor[tableName]
+    if colExists(cursor, tableName, "kCheckFlag"):
+        df = df[df["kCheckFlag"] == 'False']
+    codes, uniques = groupCodes(df, [var])
+    sums = np.bincount(codes, weights=df["Count"].values, minlength=len(uniques)).astype(np.int64)
+    sizes, n = np.unique(sums, return_counts=True)
+    return dict(zip([int(s) for s in sizes], [int(i) for i in n]))
+
+def kAnonWrap(cursor, tableName, k):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    k: minimum group size
+    gets list of variables from user input, updates kkey, checks for k-anonymity
+    """
+    varList = qiPicker(cursor, tableName)
+    kkeyUpdate(cursor, tableName, varList)
+    a,b = isTableKanonymous(cursor, tableName,k)
+    return a,b
+
+def userKanon(cursor, tableName, userVar, courseVar, k):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    userVar: string, name of userid variable
+    courseVar: string, name of course variable
+    k: minimum group size
+    drops course records until every combination of courses taken is shared
+    by at least k users, see userKanon in de_id_functions.py
+    returns dict of course to number of rows dropped
+    """
+    courseList = courseComboUpdate(cursor,tableName,userVar,courseVar)
+    courseCount = len(courseList)
+    comboCounts = comboFreq(cursor, tableName, userVar)
+    value, uniqueList, nonUniqueList = uniqUserSplit(comboCounts, k, courseCount)
+    uniqUserFlag(cursor, tableName, uniqueList)
+    courseDrops = {}
+    while value != 0.0:
+        print "non-anon value: "+str(value)
+        preQry = [(comboEncode(combo, courseCount), n) for combo, n in comboCounts.iteritems() if n < k]
+        courseTup = optimumDrop(cursor, tableName, userVar, k, nonUniqueList, preQry=preQry)
+        if len(courseTup) == 0 or len(courseTup[2])==0:
+            return courseDrops
+        courseNum = courseTup[0]
+        changeVals = courseTup[2]
+        courseName = courseList[courseNum]
+        prevDrops = courseDrops.get(courseName)
+        courseDrops = courseDropper(cursor, tableName, courseVar, courseName, changeVals, courseDrops)
+        if courseDrops.get(courseName) == prevDrops:
+            print "no rows deleted for "+courseName+", stopping"
+            return courseDrops
+        comboDropUpdate(cursor, tableName, courseNum, changeVals, comboCounts, k, courseCount)
+        value, uniqueList, nonUniqueList = uniqUserSplit(comboCounts, k, courseCount)
+    return courseDrops
+
+def courseComboUpdate(cursor, tableName, userVar, courseVar, batchSize=50000):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    userVar: string, name of userid variable
+    courseVar: string, name of course variable
+    batchSize: int, unused, kept for the same signature as the sqlite version
+    fills course_combo with a bitmask of the courses each user has taken, bit i
+    set meaning courseList[i] (see comboEncode). Returns courseList
+    """
+    startTime = datetime.datetime.now()
+    print "creating/overwriting course_combo"
+    df = cursor[tableName]
+    courseCodes, courseList = pd.factorize(df[courseVar].values, sort=True)
+    courseList = list(courseList)
+    userCodes, users = pd.factorize(df[userVar].values)
+    if len(courseList) <= 64:
+        bits = np.left_shift(np.uint64(1), courseCodes.astype(np.uint64))
+        order = np.argsort(userCodes, kind="mergesort")
+        starts = np.flatnonzero(np.r_[True, np.diff(userCodes[order]) != 0])
+        masks = np.bitwise_or.reduceat(bits[order], starts).view(np.int64)
+        df["course_combo"] = masks[userCodes]
+    else:
+        masks = collections.defaultdict(int)
+        for user, pos in itertools.izip(userCodes, courseCodes):
+            masks[user] |= 1 << int(pos)
+        combos = np.empty(len(users), dtype=object)
+        for user, mask in masks.iteritems():
+            combos[user] = comboEncode(mask, len(courseList))
+        df["course_combo"] = combos[userCodes]
+    timeReport("course_combo for "+str(len(users))+" users", len(users), startTime, "users")
+    return courseList
+
+def courseUserQry(cursor, tableName, userVar, records='all'):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    userVar: string, name of userid variable
+    records: string, 'all' 'True' or 'False'
+    returns list of (course combo, number of unique users), records option
+    allows for just getting users with "unique" (i.e. n<k) course combo values
+    """
+    df = cursor[tableName]
+    if records != 'all':
+        df = df[df["uniqUserFlag"] == records]
+    pairs = df[[userVar, "course_combo"]].drop_duplicates()
+    codes, uniques = groupCodes(pairs, ["course_combo"])
+    n = np.bincount(codes, minlength=len(uniques))
+    return zip([u[0] for u in uniques], [int(i) for i in n])
+
+def comboFreq(cursor, tableName, userVar):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    userVar: string, name of userid variable
+    returns dict of course_combo bitset to number of users with that combo
+    """
+    qry = courseUserQry(cursor, tableName, userVar)
+    return dict((comboDecode(row[0]), row[1]) for row in qry)
+
+def comboDropUpdate(cursor, tableName, courseNum, changeVals, comboCounts, k, courseCount):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    courseNum: int, position in courseList of the course that was dropped
+    changeVals: list, course_combo values passed to courseDropper
+    comboCounts: dict of course_combo bitset to number of users, updated in place
+    k: minimum group size
+    courseCount: int, number of courses in courseList
+    run after courseDropper, moves the users with a combo in changeVals to
+    the combo without the dropped course and fixes course_combo and uniqUserFlag
+    """
+    df = cursor[tableName]
+    bit = 1 << courseNum
+    newVals = {}
+    prevCounts = {}
+    for val in changeVals:
+        combo = comboDecode(val)
+        newCombo = combo & ~bit
+        users = comboCounts.pop(combo, 0)
+        if newCombo == 0:
+            continue
+        if newCombo not in prevCounts:
+            prevCounts[newCombo] = comboCounts.get(newCombo, 0)
+        comboCounts[newCombo] = comboCounts.get(newCombo, 0)+users
+        newVals[val] = newCombo
+    cleared = [comboEncode(newCombo, courseCount) for newCombo, prev in prevCounts.iteritems() if 0 < prev < k <= comboCounts[newCombo]]
+    df.loc[df["course_combo"].isin(cleared).values, "uniqUserFlag"] = 'False'
+    moved = df["course_combo"].isin(newVals.keys()).values
+    oldVals = df["course_combo"].values[moved]
+    df.loc[moved, "uniqUserFlag"] = ['False' if comboCounts[newVals[val]] >= k else 'True' for val in oldVals]
+    df.loc[moved, "course_combo"] = [comboEncode(newVals[val], courseCount) for val in oldVals]
+
+def uniqUserFlag(cursor, tableName, uniqueList):
+    """
+    cursor: FrameStore
+    tableName: string, name of main table
+    uniqueList: list, list of unique values of course_combo
+    """
+    df = cursor[tableName]
+    df["uniqUserFlag"] = np.where(df["course_combo"].isin(uniqueList).values, 'True', 'False').astype(object)
+
+def optimumDrop(cursor, tableName, userVar, k, nonUniqueList, nComb=1, preQry=None):
+    """
+    cursor: FrameStore
+    same as optimumDrop in de_id_functions.py, which does the search once the
+    flagged combos are counted
+    """
+    if preQry is None:
+        preQry = courseUserQry(cursor, tableName, userVar, 'True')
+    return de_id_functions.optimumDrop(None, tableName, userVar, k, nonUniqueList, nComb, preQry)
+
+def courseDropper(cursor, tableName, courseVar, courseName, changeVals, courseDict={}):
+    """
+    courseName: string, name of course to be dropped
+    changeVals: list, values of course_combo to drop
+    courseDict: dictionary of courses and running tally of rows dropped
+    drops course record where course equals courseName
+    AND uniqUserFlag = "True" AND course_combo is in changeVals
+    """
+    df = cursor[tableName]
+    drop = ((df[courseVar] == courseName) & (df["uniqUserFlag"] == 'True')).values & df["course_combo"].isin(changeVals).values
+    dropCounts = df.loc[drop].groupby("course_combo")["Count"].sum()
+    for val in changeVals:
+        if not dropCounts.get(val, 0):
+            return courseDict
+    courseDict[courseName] = courseDict.get(courseName, 0)+int(dropCounts.sum())
+    cursor[tableName] = df.loc[~drop].reset_index(drop=True)
+    return courseDict
+
+#################
+# Functions for censoring
+# run after doing all generalizing
+#################
+
+def contCensor(cursor, tableName, varName1, varName2):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varName1: string, name of variable containing country names
+    varName2: string, name of variable containing continent names
+    similar to contSwap, only does it for all rows with a "False" export_flag
+    """
+    df = cursor[tableName]
+    rows = (df["export_flag"] == 'False').values
+    df.loc[rows, varName1+"_DI"] = df.loc[rows, varName2]
+
+def censor(cursor, tableName, varName, value=""):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varName: string, name of variable to censor
+    sets value of given variable to specified value
+    default blank, for rows with export_flag = 'False'
+    """
+    df = cursor[tableName]
+    df.loc[(df["export_flag"] == 'False').values, varName] = value
+
+######################
+# Misc. Helper functions
+######################
+
+def dataUpdate(cursor,tableName,varName,catMap, newVar=False, newVarName = ''):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    varName: name of variable to update values
+    catMap: dict, mapping of old values to new
+    newVar: bool, optional, flag for if updated variable is different from key variable
+    newVarName: if newVar==True, must provide name of target variable
+    values of varName not in catMap are left as they are
+    """
+    df = cursor[tableName]
+    if newVar:
+        target = newVarName
+    else:
+        target = varName
+    codes, uniques = groupCodes(df, [varName])
+    mapped = [u[0] in catMap for u in uniques]
+    newVals = np.array([catMap[u[0]] if m else None for u, m in zip(uniques, mapped)], dtype=object)
+    rows = np.array(mapped, dtype=bool)[codes]
+    df.loc[rows, target] = newVals[codes[rows]]
+
+#######################
+#
+# Functions for exporting de-identified file
+#
+######################
+
+def csvExport(cursor, tableName, outFileName):
+    """
+    cursor: FrameStore
+    tableName: string, name of table
+    outFileName: name of file to write to
+    asks user to specify columns to export to a .csv file, rows with kCheckFlag = 'True'
+    """
+    varList = qiPicker(cursor, tableName)
+    headers = [str(var[1]) for var in varList]
+    df = cursor[tableName]
+    df.loc[(df["kCheckFlag"] == 'True').values, headers].to_csv(outFileName, index=False, encoding="utf-8", line_terminator="\r\n")
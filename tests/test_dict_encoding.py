@@ -0,0 +1,109 @@
+import os, sys, csv, random, sqlite3, tempfile, shutil, unittest, __builtin__
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from de_id_functions import *
+
+
+class DictEncodingTest(unittest.TestCase):
+    """
+    runs the same steps on a plain and a dictionary encoded table and checks
+    that kcheck and the export come out the same
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, "source.csv")
+        rnd = random.Random(7)
+        with open(self.source, "w") as outFile:
+            writer = csv.writer(outFile)
+            writer.writerow(["user_id", "final_cc", "gender", "YoB"])
+            for i in range(3000):
+                writer.writerow([str(i), rnd.choice(["US", "US", "GB", "FR", "ZZ", "CA", "IN", ""]),
+                                 rnd.choice(["m", "f", "o", "NA"]), str(rnd.randint(1950, 1995))])
+        self.raw_input = __builtin__.raw_input
+
+    def tearDown(self):
+        __builtin__.raw_input = self.raw_input
+        shutil.rmtree(self.dir)
+
+    def answer(self, cursor, varList):
+        cursor.execute("Pragma table_info(source)")
+        cols = [col[1] for col in cursor.fetchall()]
+        choice = ",".join(str(cols.index(var)) for var in varList)
+        __builtin__.raw_input = lambda prompt="": choice
+
+    def run_steps(self, encode, swap=False):
+        cursor = sqlite3.connect(":memory:").cursor()
+        sourceLoad(cursor, self.source, "source")
+        if swap:
+            addColumn(cursor, "source", "continent")
+            # ZZ and CA have no continent, so contSwap maps them to None
+            cursor.execute("UPDATE source SET continent = CASE final_cc WHEN 'US' THEN 'Americas' WHEN 'GB' THEN 'Europe' WHEN 'FR' THEN 'Europe' WHEN 'IN' THEN 'Asia' END")
+            cursor.execute("UPDATE source SET final_cc = NULL WHERE final_cc = ''")
+        if encode:
+            for var in ["final_cc", "continent", "gender", "YoB"]:
+                if colExists(cursor, "source", var):
+                    dictEncode(cursor, "source", var)
+        if swap:
+            contSwap(cursor, "source", "final_cc", "continent", 400)
+        else:
+            colCopy(cursor, "source", "final_cc", "final_cc_DI")
+            # ZZ and CA go to None, IN to the text 'NULL', which groups with NULL
+            dataUpdate(cursor, "source", "final_cc_DI", {"ZZ": None, "CA": None, "IN": "NULL"})
+        varList = ["final_cc_DI", "gender", "YoB"]
+        self.answer(cursor, varList)
+        iterKcheck(cursor, "source", 5)
+        outFileName = os.path.join(self.dir, "export_"+str(encode)+".csv")
+        self.answer(cursor, ["user_id"]+varList)
+        csvExport(cursor, "source", outFileName)
+        with open(outFileName) as inFile:
+            rows = list(csv.reader(inFile))
+        return selUnique(cursor, "source", "final_cc_DI"), selUnique(cursor, "source", "kCheckFlag"), rows
+
+    def test_remap_to_none(self):
+        plain = self.run_steps(False)
+        encoded = self.run_steps(True)
+        self.assertIsNone(plain[0][0][0])
+        self.assertEqual(plain[0], encoded[0])
+        self.assertEqual(plain[1], encoded[1])
+        self.assertEqual(plain[2], encoded[2])
+
+    def test_contswap_to_none(self):
+        plain = self.run_steps(False, True)
+        encoded = self.run_steps(True, True)
+        self.assertIsNone(plain[0][0][0])
+        self.assertIn("NULL", colToList(plain[0]))
+        self.assertEqual(plain[0], encoded[0])
+        self.assertEqual(plain[1], encoded[1])
+        self.assertEqual(plain[2], encoded[2])
+
+    def test_tailfinder(self):
+        results = []
+        for encode in [False, True]:
+            cursor = sqlite3.connect(":memory:").cursor()
+            sourceLoad(cursor, self.source, "source")
+            cursor.execute("UPDATE source SET YoB = 'NA' WHERE user_id LIKE '%7'")
+            if encode:
+                dictEncode(cursor, "source", "YoB")
+            answers = iter(["y", "b", "1955", "1990"])
+            __builtin__.raw_input = lambda prompt="": next(answers)
+            tailFinder(cursor, "source", "YoB", 100)
+            results.append(selUnique(cursor, "source", "YoB_DI"))
+        # NA is not an int, so it is left NULL
+        self.assertIsNone(results[0][0][0])
+        self.assertNotIn("NA", colToList(results[0]))
+        self.assertIn("<= 1955", colToList(results[0]))
+        self.assertEqual(results[0], results[1])
+
+    def test_column_order(self):
+        cursor = sqlite3.connect(":memory:").cursor()
+        sourceLoad(cursor, self.source, "source")
+        cursor.execute("Pragma table_info(source)")
+        before = [col[1] for col in cursor.fetchall()]
+        dictEncode(cursor, "source", "gender")
+        dictDecode(cursor, "source", "gender")
+        dictEncode(cursor, "source", "final_cc")
+        cursor.execute("Pragma table_info(source)")
+        self.assertEqual(before, [col[1] for col in cursor.fetchall()])
+
+if __name__ == "__main__":
+    unittest.main()
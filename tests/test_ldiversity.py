@@ -0,0 +1,40 @@
+import os, sys, sqlite3, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from de_id_functions import *
+
+
+class LDiversityTest(unittest.TestCase):
+    """
+    entropy l-diversity on classes with l equally frequent values, which
+    are entropy l-diverse by definition
+    """
+
+    def uniformTable(self, l, size=2):
+        cursor = sqlite3.connect(":memory:").cursor()
+        cursor.execute("CREATE TABLE source (kkey integer, grade text, Count integer)")
+        rows = []
+        for i in range(l):
+            rows += [(1, "g"+str(i), 1)]*size
+        # class 2 has one value more often than the others
+        rows += [(2, "g0", 1)]*3+[(2, "g1", 1), (2, "g2", 1)]
+        cursor.executemany("INSERT INTO source VALUES (?, ?, ?)", rows)
+        return cursor
+
+    def test_uniform_class_passes(self):
+        for l in [2, 3, 7, 9, 11]:
+            cursor = self.uniformTable(l)
+            report = dict((row[0], row) for row in lDiversity(cursor, "source", "kkey", "grade", l, "entropy"))
+            self.assertTrue(report[1][4], (l, report[1]))
+            cursor.execute("SELECT COUNT(*) FROM source WHERE kkey = 1 AND grade = ' '")
+            self.assertEqual(cursor.fetchall()[0][0], 0)
+
+    def test_skewed_class_fails(self):
+        cursor = self.uniformTable(3)
+        report = dict((row[0], row) for row in lDiversity(cursor, "source", "kkey", "grade", 3, "entropy"))
+        self.assertFalse(report[2][4])
+        cursor.execute("SELECT DISTINCT grade FROM source WHERE kkey = 2")
+        self.assertEqual(cursor.fetchall(), [(u" ",)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import os, sys, random, sqlite3, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from de_id_functions import *
+
+
+def fullKanon(cursor, tableName, userVar, courseVar, k):
+    """
+    the userKanon loop as it was before the incremental updates, recomputing
+    course_combo, the combo frequencies and uniqUserFlag over the whole table
+    after every drop, and letting optimumDrop query the table itself
+    """
+    courseList = courseComboUpdate(cursor, tableName, userVar, courseVar)
+    value, uniqueList, nonUniqueList = uniqUserCheck(cursor, tableName, userVar, k)
+    uniqUserFlag(cursor, tableName, uniqueList)
+    courseDrops = {}
+    while value != 0.0:
+        courseTup = optimumDrop(cursor, tableName, userVar, k, nonUniqueList)
+        if len(courseTup) == 0 or len(courseTup[2]) == 0:
+            return courseDrops
+        courseName = courseList[courseTup[0]]
+        prevDrops = courseDrops.get(courseName)
+        courseDrops = courseDropper(cursor, tableName, courseVar, courseName, courseTup[2], courseDrops)
+        if courseDrops.get(courseName) == prevDrops:
+            return courseDrops
+        courseList = courseComboUpdate(cursor, tableName, userVar, courseVar)
+        value, uniqueList, nonUniqueList = uniqUserCheck(cursor, tableName, userVar, k)
+        uniqUserFlag(cursor, tableName, uniqueList)
+    return courseDrops
+
+
+class UserKanonTest(unittest.TestCase):
+    """
+    runs the incremental userKanon loop and the full recompute on the same
+    table and checks that they drop the same rows
+    """
+
+    def courseTable(self, courseCount, userCount=400):
+        cursor = sqlite3.connect(":memory:").cursor()
+        cursor.execute("CREATE TABLE source (user_id text, course_id text, Count integer)")
+        rnd = random.Random(11)
+        courses = ["c"+str(i).zfill(2) for i in range(courseCount)]
+        rows = []
+        for user in range(userCount):
+            # a few popular courses, so there are both common and rare combos
+            taken = [course for course in courses[:4] if rnd.random() < 0.6]
+            taken += rnd.sample(courses[4:], rnd.randint(0, 2))
+            rows += [("u"+str(user), course, 1) for course in taken or courses[:1]]
+        cursor.executemany("INSERT INTO source VALUES (?, ?, ?)", rows)
+        return cursor
+
+    def compare(self, courseCount, k):
+        results = []
+        for kanon in [userKanon, fullKanon]:
+            cursor = self.courseTable(courseCount)
+            courseDrops = kanon(cursor, "source", "user_id", "course_id", k)
+            cursor.execute("SELECT user_id, course_id, uniqUserFlag FROM source ORDER BY user_id, course_id")
+            results.append((courseDrops, cursor.fetchall()))
+        self.assertTrue(results[0][0])
+        self.assertEqual(results[0], results[1])
+
+    def test_integer_combos(self):
+        self.compare(8, 5)
+
+    def test_blob_combos(self):
+        # more than 64 courses, course_combo is stored as a blob
+        self.compare(70, 3)
+
+    def test_optimumdrop_prequery(self):
+        cursor = self.courseTable(8)
+        courseList = courseComboUpdate(cursor, "source", "user_id", "course_id")
+        comboCounts = comboFreq(cursor, "source", "user_id")
+        value, uniqueList, nonUniqueList = uniqUserSplit(comboCounts, 5, len(courseList))
+        uniqUserFlag(cursor, "source", uniqueList)
+        preQry = [(comboEncode(combo, len(courseList)), n) for combo, n in comboCounts.iteritems() if n < 5]
+        self.assertEqual(optimumDrop(cursor, "source", "user_id", 5, nonUniqueList, preQry=preQry),
+                         optimumDrop(cursor, "source", "user_id", 5, nonUniqueList))
+
+
+if __name__ == "__main__":
+    unittest.main()